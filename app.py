@@ -1,10 +1,13 @@
 import streamlit as st
 import os
+import re
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+
+from core.utils import setup_logging
 
 # Load environment variables
 load_dotenv()
+setup_logging()
 
 # Configure Streamlit page
 st.set_page_config(
@@ -14,37 +17,21 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Custom CSS for better styling
-st.markdown("""
-<style>
-    .main > div {
-        padding-top: 2rem;
-    }
-    .stSidebar > div {
-        padding-top: 2rem;
-    }
-    .chat-message {
-        padding: 1rem;
-        border-radius: 0.5rem;
-        margin: 1rem 0;
-    }
-    .user-message {
-        background-color: #e3f2fd;
-        border-left: 4px solid #2196f3;
-    }
-    .assistant-message {
-        background-color: #f3e5f5;
-        border-left: 4px solid #9c27b0;
-    }
-    .token-counter {
-        background-color: #fff3e0;
-        padding: 0.5rem;
-        border-radius: 0.25rem;
-        border: 1px solid #ffb74d;
-        margin: 0.5rem 0;
-    }
-</style>
-""", unsafe_allow_html=True)
+@st.cache_resource(show_spinner=False)
+def load_css() -> str:
+    """Read assets/style.css once per process"""
+    css_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "style.css")
+    with open(css_path, encoding="utf-8") as f:
+        css = f.read()
+    
+    # Strip comments and collapse whitespace runs; selectors and declarations are left as written
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    return f"<style>{css.strip()}</style>"
+
+# Custom CSS for better styling (the rules app.py used to inline). Streamlit drops elements
+# that are not re-emitted, so the cached stylesheet is still written on every rerun.
+st.markdown(load_css(), unsafe_allow_html=True)
 
 def main():
     # Check if user is logged in
@@ -60,15 +47,14 @@ def main():
     if 'login_time' not in st.session_state:
         st.session_state.login_time = None
     
-    # Check session timeout
-    if st.session_state.user_id and st.session_state.login_time:
-        timeout_minutes = int(os.getenv('SESSION_TIMEOUT_MINUTES', 30))
-        if datetime.now() - st.session_state.login_time > timedelta(minutes=timeout_minutes):
-            st.session_state.user_id = None
-            st.session_state.username = None
-            st.session_state.is_admin = False
-            st.session_state.login_time = None
-            st.warning("Session expired. Please log in again.")
+    # Check session timeout (core.auth reads BCRYPT_COST at import, so import after load_dotenv)
+    from core.auth import session_expired
+    if st.session_state.user_id and session_expired(st.session_state.login_time):
+        st.session_state.user_id = None
+        st.session_state.username = None
+        st.session_state.is_admin = False
+        st.session_state.login_time = None
+        st.warning("Session expired. Please log in again.")
     
     # Navigation using dropdown
     if st.session_state.user_id is None:
@@ -89,13 +75,11 @@ def main():
         st.sidebar.success(f"Welcome, {st.session_state.username}!")
         st.sidebar.markdown("### Navigation")
         
-        # Check if user is admin
-        from core.auth import is_admin
-        
         # Build navigation options based on user role
+        # (admin flag is stored in session state at login, so no DB call per rerun)
         page_options = ["💬 Chat"]
-        
-        if is_admin(st.session_state.user_id):
+
+        if st.session_state.is_admin:
             page_options.append("👑 Admin Dashboard")
         
         page_options.append("🚪 Logout")
@@ -2,32 +2,83 @@
 Authentication module for user management
 """
 import bcrypt
+import functools
+import httpx
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
-from supabase import create_client, Client
+from postgrest.exceptions import APIError
+from supabase import create_client, Client, ClientOptions
 
-def get_supabase_client() -> Client:
-    """Get Supabase client with lazy initialization"""
+logger = logging.getLogger(__name__)
+
+# bcrypt work factor, read once per process; 10 keeps a login around ~50 ms
+_BCRYPT_ROUNDS = int(os.getenv("BCRYPT_COST", "10"))
+
+# Postgres error code for unique constraint violations
+UNIQUE_VIOLATION = "23505"
+
+# bcrypt>=4 releases the GIL while hashing, so a thread pool sized to the CPU count
+# runs concurrent logins in parallel without oversubscribing the cores
+_BCRYPT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="bcrypt")
+
+def create_supabase_client(supabase_key: Optional[str], max_connections: Optional[int] = None,
+                           max_keepalive_connections: int = 10) -> Client:
+    """Create a Supabase client over a pooled HTTP/2 connection with keep-alive"""
     supabase_url = os.getenv("SUPABASE_URL")
-    supabase_key = os.getenv("SUPABASE_ANON_KEY")
     
     if not supabase_url or not supabase_key:
         raise ValueError("Supabase URL and key must be set in environment variables")
     
-    return create_client(supabase_url, supabase_key)
+    # Pooled HTTP/2 connections with keep-alive instead of a fresh TLS handshake per query
+    http_client = httpx.Client(
+        http2=True,
+        timeout=float(os.getenv("SUPABASE_TIMEOUT_SECONDS", "10")),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+        follow_redirects=True
+    )
+    
+    return create_client(supabase_url, supabase_key, options=ClientOptions(httpx_client=http_client))
+
+@functools.lru_cache(maxsize=1)
+def get_supabase_client() -> Client:
+    """Get Supabase client, created once per process and reused across reruns"""
+    return create_supabase_client(os.getenv("SUPABASE_ANON_KEY"))
+
+@functools.lru_cache(maxsize=1)
+def get_service_client() -> Client:
+    """Get the service-role Supabase client for writes the anon key's RLS policies reject"""
+    return create_supabase_client(os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
 
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt"""
     if not password:
         raise ValueError("Password cannot be empty")
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+    salt = bcrypt.gensalt(rounds=_BCRYPT_ROUNDS)
+    return _BCRYPT_POOL.submit(bcrypt.hashpw, password.encode('utf-8'), salt).result().decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     """Verify a password against its hash"""
     if not password or not hashed:
         return False
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    return _BCRYPT_POOL.submit(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8')).result()
+
+def needs_rehash(hashed: str) -> bool:
+    """Check if a stored hash was created with a lower work factor than the current policy"""
+    try:
+        # bcrypt hashes look like $2b$<cost>$<salt+hash>; stronger hashes are left alone
+        return int(hashed.split("$")[2]) < _BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+def session_expired(login_time: Optional[datetime]) -> bool:
+    """Check if a login is older than SESSION_TIMEOUT_MINUTES"""
+    if login_time is None:
+        return False
+    timeout_minutes = int(os.getenv('SESSION_TIMEOUT_MINUTES', 30))
+    return datetime.now() - login_time > timedelta(minutes=timeout_minutes)
 
 def register_user(username: str, email: str, password: str) -> Dict[str, Any]:
     """Register a new user"""
@@ -49,20 +100,20 @@ def register_user(username: str, email: str, password: str) -> Dict[str, Any]:
         
         supabase = get_supabase_client()
         
-        # Check if username already exists
-        existing = supabase.table("users").select("username").eq("username", username).execute()
-        if existing.data:
-            return {"success": False, "error": "Username already exists"}
-        
         # Hash password
         password_hash = hash_password(password)
         
-        # Insert user
-        result = supabase.table("users").insert({
-            "username": username,
-            "email": email,
-            "password_hash": password_hash
-        }).execute()
+        # Insert user; the UNIQUE constraint on username rejects duplicates
+        try:
+            result = supabase.table("users").insert({
+                "username": username,
+                "email": email,
+                "password_hash": password_hash
+            }).execute()
+        except APIError as e:
+            if e.code == UNIQUE_VIOLATION:
+                return {"success": False, "error": "Username already exists"}
+            raise
         
         if result.data:
             return {"success": True, "user": result.data[0]}
@@ -88,8 +139,11 @@ def login_user(username: str, password: str) -> Dict[str, Any]:
         
         supabase = get_supabase_client()
         
-        # Get user by username
-        result = supabase.table("users").select("*").eq("username", username).execute()
+        # Get user by username (only the columns the session needs, plus the hash to verify)
+        result = supabase.table("users")\
+            .select("id, username, email, is_admin, password_hash, created_at")\
+            .eq("username", username)\
+            .execute()
         
         if not result.data:
             return {"success": False, "error": "User not found"}
@@ -98,6 +152,18 @@ def login_user(username: str, password: str) -> Dict[str, Any]:
         
         # Verify password
         if verify_password(password, user["password_hash"]):
+            # Upgrade the stored hash if it is weaker than the work factor policy. The anon
+            # key's RLS update policy matches no rows here, so this uses the service role.
+            if needs_rehash(user["password_hash"]):
+                try:
+                    updated = get_service_client().table("users").update({
+                        "password_hash": hash_password(password)
+                    }).eq("id", user["id"]).execute()
+                    if not updated.data:
+                        logger.warning("Password hash upgrade matched no rows", extra={"user_id": user["id"]})
+                except Exception:
+                    logger.exception("Error updating password hash", extra={"user_id": user["id"]})
+            
             # Remove password hash from returned data
             user_data = {k: v for k, v in user.items() if k != "password_hash"}
             return {"success": True, "user": user_data}
@@ -119,22 +185,23 @@ def get_user_by_id(user_id: str) -> Optional[Dict[str, Any]]:
             return {k: v for k, v in user.items() if k != "password_hash"}
         return None
         
-    except Exception as e:
-        print(f"Error getting user: {e}")
+    except Exception:
+        logger.exception("Error getting user", extra={"user_id": user_id})
         return None
 
-def is_admin(user_id: str) -> bool:
-    """Check if user is admin"""
+def is_admin(user_id: str, raise_errors: bool = False) -> bool:
+    """Check if user is admin; with raise_errors, a failed check raises instead of returning False"""
     try:
         supabase = get_supabase_client()
-        result = supabase.table("users").select("is_admin").eq("id", user_id).execute()
         
-        if result.data:
-            return result.data[0].get("is_admin", False)
-        return False
+        # The is_admin() SQL function returns a bare boolean
+        result = supabase.rpc("is_admin", {"uid": user_id}).execute()
+        return bool(result.data)
         
-    except Exception as e:
-        print(f"Error checking admin status: {e}")
+    except Exception:
+        if raise_errors:
+            raise
+        logger.exception("Error checking admin status", extra={"user_id": user_id})
         return False
 
 def get_all_users() -> list:
@@ -144,6 +211,6 @@ def get_all_users() -> list:
         result = supabase.table("users").select("id, username, email, is_admin, created_at").execute()
         return result.data or []
         
-    except Exception as e:
-        print(f"Error getting all users: {e}")
+    except Exception:
+        logger.exception("Error getting all users")
         return []
\ No newline at end of file
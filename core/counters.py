@@ -1,10 +1,18 @@
-import tiktoken
-from typing import List, Dict, Any
+import functools
+import os
 import re
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Tuple
 
 class TokenCounter:
     """Token counting utilities for different providers"""
     
+    _TEXT_COUNTS_SIZE = 4096
+    
+    # Below this many texts, encode_batch's thread pool startup costs more than it saves
+    _ENCODE_BATCH_MIN_TEXTS = 32
+    
     def __init__(self):
         # Token pricing per 1K tokens (2025 pricing)
         self.pricing = {
@@ -46,6 +54,87 @@ class TokenCounter:
                 "gemini-pro-vision": {"input": 0.0005, "output": 0.0015}
             }
         }
+        
+        # Model name substring -> tiktoken model whose encoding it uses (first match wins).
+        # New 2025 models use GPT-4 encoding.
+        self._encoding_families = [
+            ("gpt-4.1", "gpt-4"),
+            ("o3", "gpt-4"),
+            ("gpt-4o", "gpt-4"),
+            ("o4-mini", "gpt-4"),
+            ("gpt-4", "gpt-4"),
+            ("gpt-3.5-turbo", "gpt-3.5-turbo")
+        ]
+        
+        # Encodings are resolved on first use and reused for every later call
+        self._encodings = {}
+        
+        # Fuzzy pricing fallback for model names without an exact entry:
+        # (substrings that must all appear, pricing key), checked in order, first match wins.
+        # A None key stops the search unpriced, like a family matched with no known variant.
+        self._fuzzy_pricing = {
+            "OpenAI": [
+                (("gpt-4.1", "mini"), "gpt-4.1-mini"),
+                (("gpt-4.1", "nano"), "gpt-4.1-nano"),
+                (("gpt-4.1",), "gpt-4.1"),
+                (("o3", "pro"), "o3-pro"),
+                (("o3",), "o3"),
+                (("gpt-4o",), "gpt-4o"),
+                (("o4-mini",), "o4-mini-deep-research"),
+                (("gpt-4",), "gpt-4")
+            ],
+            "Anthropic": [
+                (("claude-4",), "claude-sonnet-4-20250514"),
+                (("sonnet-4",), "claude-sonnet-4-20250514"),
+                (("opus-4",), "claude-opus-4-20250514"),
+                (("claude-3", "opus"), "claude-3-opus-20240229"),
+                (("claude-3", "sonnet"), "claude-3-sonnet-20240229"),
+                (("claude-3", "haiku"), "claude-3-haiku-20240307"),
+                (("claude-3",), None)
+            ],
+            "Gemini": [
+                (("2.5", "pro"), "gemini-2.5-pro"),
+                (("2.5", "lite"), "gemini-2.5-flash-lite"),
+                (("2.5", "flash"), "gemini-2.5-flash"),
+                (("2.5",), None),
+                (("2.0", "lite"), "gemini-2.0-flash-lite"),
+                (("2.0",), "gemini-2.0-flash"),
+                (("gemini-pro",), "gemini-pro")
+            ]
+        }
+        
+        # Compile each provider's fuzzy rules into one anchored regex: every rule becomes a
+        # named alternative of lookaheads, so a single match() finds the first matching rule
+        self._fuzzy_pricing_re = {}
+        self._fuzzy_pricing_keys = {}
+        for provider, rules in self._fuzzy_pricing.items():
+            alternatives = [
+                f"(?P<rule{i}>" + "".join(f"(?=.*{re.escape(pattern)})" for pattern in patterns) + ")"
+                for i, (patterns, _) in enumerate(rules)
+            ]
+            self._fuzzy_pricing_re[provider] = re.compile("|".join(alternatives))
+            self._fuzzy_pricing_keys[provider] = {f"rule{i}": key for i, (_, key) in enumerate(rules)}
+        
+        # Character-based estimators for providers without a local tokenizer
+        # (Claude: ~3.8 chars per token, Gemini: ~3.7 chars per token)
+        self._chars_per_token = {
+            "Anthropic": 3.8,
+            "Gemini": 3.7
+        }
+        
+        # Provider -> counting function, taking (model, text)
+        self._token_counters = {
+            "OpenAI": self._count_openai_tokens,
+            "Anthropic": lambda model, text: self._count_anthropic_tokens(text),
+            "Gemini": lambda model, text: self._count_gemini_tokens(text)
+        }
+        
+        # Per-text token counts keyed by (provider, model, text), least recently used first.
+        # Streamlit reruns and new turns recount the same history, so only new texts get
+        # tokenized; each model's pricing is likewise resolved once
+        self._text_counts: "OrderedDict[Tuple[str, str, str], int]" = OrderedDict()
+        self._text_counts_lock = threading.Lock()
+        self._get_model_pricing = functools.lru_cache(maxsize=256)(self._lookup_model_pricing)
     
     def is_model_supported(self, provider: str, model: str) -> bool:
         """Check if a model is supported by the provider"""
@@ -58,144 +147,146 @@ class TokenCounter:
     
     def count_tokens(self, provider: str, model: str, text: str) -> int:
         """Count tokens in text for specific provider/model"""
-        if provider == "OpenAI":
-            return self._count_openai_tokens(model, text)
-        elif provider == "Anthropic":
-            return self._count_anthropic_tokens(text)
-        elif provider == "Gemini":
-            return self._count_gemini_tokens(text)
-        else:
-            return len(text.split())  # Fallback word count
+        return self._count_texts(provider, model, [text])
+    
+    def _count_words(self, model: str, text: str) -> int:
+        """Fallback word count for unknown providers"""
+        return len(text.split())
     
     def count_messages_tokens(self, provider: str, model: str, messages: List[Dict[str, str]]) -> int:
         """Count total tokens in message list"""
-        total_tokens = 0
+        contents = [message.get("content", "") for message in messages]
         
-        for message in messages:
-            content = message.get("content", "")
-            role = message.get("role", "")
-            
-            # Count content tokens
-            total_tokens += self.count_tokens(provider, model, content)
-            
-            # Add overhead for role and formatting (approximate)
-            total_tokens += 4  # For role and message formatting
+        # Count content tokens
+        total_tokens = self._count_texts(provider, model, contents)
+        
+        # Add overhead for role and formatting (approximate)
+        total_tokens += 4 * len(messages)  # For role and message formatting
         
         # Add conversation overhead
         total_tokens += 3
         
         return total_tokens
     
-    def _count_openai_tokens(self, model: str, text: str) -> int:
-        """Count tokens using tiktoken for OpenAI models"""
-        try:
+    def _count_texts(self, provider: str, model: str, texts: List[str]) -> int:
+        """Total tokens for several texts, counting only texts not seen before"""
+        counts = [None] * len(texts)
+        
+        with self._text_counts_lock:
+            for i, text in enumerate(texts):
+                key = (provider, model, text)
+                count = self._text_counts.get(key)
+                if count is not None:
+                    self._text_counts.move_to_end(key)
+                    counts[i] = count
+        
+        missing = [i for i, count in enumerate(counts) if count is None]
+        if missing:
+            lengths = self._count_uncached(provider, model, [texts[i] for i in missing])
+            
+            with self._text_counts_lock:
+                for i, count in zip(missing, lengths):
+                    counts[i] = count
+                    self._text_counts[(provider, model, texts[i])] = count
+                while len(self._text_counts) > self._TEXT_COUNTS_SIZE:
+                    self._text_counts.popitem(last=False)
+        
+        return sum(counts)
+    
+    def _count_uncached(self, provider: str, model: str, texts: List[str]) -> List[int]:
+        """Per-text token counts without memoization"""
+        if provider == "OpenAI":
+            return self._encode_openai_lengths(model, texts)
+        counter = self._token_counters.get(provider, self._count_words)
+        return [counter(model, text) for text in texts]
+    
+    def _get_openai_encoding(self, model: str):
+        """Get the tiktoken encoding for an OpenAI model, cached per model"""
+        encoding = self._encodings.get(model)
+        if encoding is None:
+            # Imported lazily: tiktoken and its BPE tables are only needed for OpenAI counts
+            import tiktoken
+            
             model_lower = model.lower()
             
             # Use appropriate encoding for different model families
-            if any(x in model_lower for x in ["gpt-4.1", "o3", "gpt-4o", "o4-mini"]):
-                # New 2025 models use GPT-4 encoding
-                encoding = tiktoken.encoding_for_model("gpt-4")
-            elif "gpt-4" in model_lower:
-                encoding = tiktoken.encoding_for_model("gpt-4")
-            elif "gpt-3.5-turbo" in model_lower:
-                encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+            encoding_model = next(
+                (name for pattern, name in self._encoding_families if pattern in model_lower),
+                None
+            )
+            if encoding_model:
+                encoding = tiktoken.encoding_for_model(encoding_model)
             else:
                 # Default to cl100k_base for unknown models
                 encoding = tiktoken.get_encoding("cl100k_base")
             
+            self._encodings[model] = encoding
+        
+        return encoding
+    
+    def _count_openai_tokens(self, model: str, text: str) -> int:
+        """Count tokens using tiktoken for OpenAI models"""
+        try:
+            encoding = self._get_openai_encoding(model)
             return len(encoding.encode(text))
         except Exception:
             # Fallback estimation: ~1.3 tokens per word for English text
             return int(len(text.split()) * 1.3)
     
+    def _encode_openai_lengths(self, model: str, texts: List[str]) -> List[int]:
+        """Token counts for several texts; large batches run BPE in parallel threads"""
+        if len(texts) < self._ENCODE_BATCH_MIN_TEXTS:
+            return [self._count_openai_tokens(model, text) for text in texts]
+        
+        try:
+            encoding = self._get_openai_encoding(model)
+            return [len(tokens) for tokens in encoding.encode_batch(texts, num_threads=os.cpu_count() or 1)]
+        except Exception:
+            # Fall back to per-text counting so one bad text doesn't skew the whole batch
+            return [self._count_openai_tokens(model, text) for text in texts]
+    
     def _count_anthropic_tokens(self, text: str) -> int:
         """Estimate tokens for Anthropic (Claude) models"""
         # Claude models use a similar tokenization approach to GPT models
         # For 2025 Claude 4 models: approximately 1 token ≈ 3.5-4 characters for English text
         # Being slightly more conservative with 3.8 characters per token
-        return max(1, int(len(text) / 3.8))
+        return max(1, int(len(text) / self._chars_per_token["Anthropic"]))
     
     def _count_gemini_tokens(self, text: str) -> int:
         """Estimate tokens for Gemini models"""
         # Gemini 2.5 and 2.0 models have similar tokenization to other modern LLMs
         # Approximately 1 token ≈ 3.5-4 characters for English text
         # Using 3.7 characters per token for better accuracy
-        return max(1, int(len(text) / 3.7))
+        return max(1, int(len(text) / self._chars_per_token["Gemini"]))
     
     def estimate_cost(self, provider: str, model: str, input_tokens: int, output_tokens: int) -> float:
         """Estimate cost based on token usage"""
-        try:
-            provider_pricing = self.pricing.get(provider, {})
-            
-            # Try exact model match first
-            model_pricing = provider_pricing.get(model, {})
-            
-            # If exact match not found, try fuzzy matching for common model patterns
-            if not model_pricing:
-                model_lower = model.lower()
-                
-                # OpenAI fuzzy matching
-                if provider == "OpenAI":
-                    if "gpt-4.1" in model_lower:
-                        if "mini" in model_lower:
-                            model_pricing = provider_pricing.get("gpt-4.1-mini", {})
-                        elif "nano" in model_lower:
-                            model_pricing = provider_pricing.get("gpt-4.1-nano", {})
-                        else:
-                            model_pricing = provider_pricing.get("gpt-4.1", {})
-                    elif "o3" in model_lower:
-                        if "pro" in model_lower:
-                            model_pricing = provider_pricing.get("o3-pro", {})
-                        else:
-                            model_pricing = provider_pricing.get("o3", {})
-                    elif "gpt-4o" in model_lower:
-                        model_pricing = provider_pricing.get("gpt-4o", {})
-                    elif "o4-mini" in model_lower:
-                        model_pricing = provider_pricing.get("o4-mini-deep-research", {})
-                    elif "gpt-4" in model_lower:
-                        model_pricing = provider_pricing.get("gpt-4", {})
-                
-                # Anthropic fuzzy matching
-                elif provider == "Anthropic":
-                    if "claude-4" in model_lower or "sonnet-4" in model_lower:
-                        model_pricing = provider_pricing.get("claude-sonnet-4-20250514", {})
-                    elif "opus-4" in model_lower:
-                        model_pricing = provider_pricing.get("claude-opus-4-20250514", {})
-                    elif "claude-3" in model_lower:
-                        if "opus" in model_lower:
-                            model_pricing = provider_pricing.get("claude-3-opus-20240229", {})
-                        elif "sonnet" in model_lower:
-                            model_pricing = provider_pricing.get("claude-3-sonnet-20240229", {})
-                        elif "haiku" in model_lower:
-                            model_pricing = provider_pricing.get("claude-3-haiku-20240307", {})
-                
-                # Gemini fuzzy matching
-                elif provider == "Gemini":
-                    if "2.5" in model_lower:
-                        if "pro" in model_lower:
-                            model_pricing = provider_pricing.get("gemini-2.5-pro", {})
-                        elif "flash-lite" in model_lower or "lite" in model_lower:
-                            model_pricing = provider_pricing.get("gemini-2.5-flash-lite", {})
-                        elif "flash" in model_lower:
-                            model_pricing = provider_pricing.get("gemini-2.5-flash", {})
-                    elif "2.0" in model_lower:
-                        if "lite" in model_lower:
-                            model_pricing = provider_pricing.get("gemini-2.0-flash-lite", {})
-                        else:
-                            model_pricing = provider_pricing.get("gemini-2.0-flash", {})
-                    elif "gemini-pro" in model_lower:
-                        model_pricing = provider_pricing.get("gemini-pro", {})
-            
-            if not model_pricing:
-                return 0.0
-            
-            # Convert from per-1K to per-token, then scale by actual token count
-            input_cost = (input_tokens / 1000) * model_pricing.get("input", 0)
-            output_cost = (output_tokens / 1000) * model_pricing.get("output", 0)
-            
-            return input_cost + output_cost
-        except Exception:
+        model_pricing = self._get_model_pricing(provider, model)
+        
+        if not model_pricing:
             return 0.0
+        
+        # Convert from per-1K to per-token, then scale by actual token count
+        input_cost = (input_tokens / 1000) * model_pricing.get("input", 0)
+        output_cost = (output_tokens / 1000) * model_pricing.get("output", 0)
+        
+        return input_cost + output_cost
+    
+    def _lookup_model_pricing(self, provider: str, model: str) -> Dict[str, float]:
+        """Resolve the pricing entry for a model, falling back to fuzzy name matching"""
+        provider_pricing = self.pricing.get(provider, {})
+        
+        # Try exact model match first
+        model_pricing = provider_pricing.get(model, {})
+        
+        # If exact match not found, try fuzzy matching for common model patterns
+        if not model_pricing and provider in self._fuzzy_pricing_re:
+            match = self._fuzzy_pricing_re[provider].match(model.lower())
+            if match:
+                pricing_key = self._fuzzy_pricing_keys[provider][match.lastgroup]
+                model_pricing = provider_pricing.get(pricing_key, {})
+        
+        return model_pricing
     
     def get_token_info(self, provider: str, model: str, messages: List[Dict[str, str]], 
                       response_text: str = "") -> Dict[str, Any]:
@@ -218,3 +309,8 @@ class TokenCounter:
             "model_supported": model_supported,
             "cost_accuracy": "accurate" if model_supported or estimated_cost > 0 else "estimated"
         }
+
+@functools.lru_cache(maxsize=1)
+def get_token_counter() -> TokenCounter:
+    """Get the shared TokenCounter, so pricing tables and caches are built once per process"""
+    return TokenCounter()
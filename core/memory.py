@@ -1,26 +1,124 @@
 """
 Memory management using pgvector for conversation context
 """
+import functools
+import hashlib
+import logging
 import os
-from typing import List, Dict, Any, Optional
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 from sentence_transformers import SentenceTransformer
-from supabase import create_client, Client
+from supabase import Client
+from core.auth import create_supabase_client
+from core.counters import get_token_counter
 
+logger = logging.getLogger(__name__)
+
+# Embedding model shared by every MemoryManager, loaded on first use
+_EMBEDDING_MODEL: Optional[SentenceTransformer] = None
+_EMBEDDING_MODEL_LOCK = threading.Lock()
+
+# LRU cache of embeddings keyed by a 16-byte blake2b digest of the text, so repeated
+# queries and messages skip the model without keeping the full text as a key
+_EMBEDDING_CACHE: "OrderedDict[bytes, Any]" = OrderedDict()
+_EMBEDDING_CACHE_LOCK = threading.Lock()
+_EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+
+# Background workers for memory writes that overlap other work; each worker borrows a
+# pooled connection, so the pool size matches the HTTP connection limit below
+_MEMORY_IO_WORKERS = int(os.getenv("MEMORY_IO_WORKERS", "20"))
+_MEMORY_IO_POOL = ThreadPoolExecutor(max_workers=_MEMORY_IO_WORKERS, thread_name_prefix="memory-io")
+
+# Upper bound on conversation tokens sent to the LLM per summary
+_SUMMARY_INPUT_TOKEN_BUDGET = int(os.getenv("SUMMARY_INPUT_TOKEN_BUDGET", "8000"))
+
+# Summaries run on their own pool because summarize_and_prune waits on _MEMORY_IO_POOL
+# itself; (user_id, conversation_id) pairs with a summary in progress are skipped
+_SUMMARY_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory-summary")
+_SUMMARIES_IN_FLIGHT: set = set()
+_SUMMARIES_IN_FLIGHT_LOCK = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
 def get_supabase_client() -> Client:
-    """Get Supabase client with lazy initialization"""
-    supabase_url = os.getenv("SUPABASE_URL")
-    supabase_key = os.getenv("SUPABASE_ANON_KEY")
-    
-    if not supabase_url or not supabase_key:
-        raise ValueError("Supabase URL and key must be set in environment variables")
+    """Get Supabase client, created once per process and reused across calls"""
+    # Sized so every memory I/O worker can hold its own connection
+    return create_supabase_client(
+        os.getenv("SUPABASE_ANON_KEY"),
+        max_connections=_MEMORY_IO_WORKERS,
+        max_keepalive_connections=_MEMORY_IO_WORKERS
+    )
+
+def get_embedding_model() -> SentenceTransformer:
+    """Get the shared embedding model, loading it once per process"""
+    global _EMBEDDING_MODEL
+    if _EMBEDDING_MODEL is None:
+        with _EMBEDDING_MODEL_LOCK:
+            # Re-check under the lock so concurrent sessions load the model only once
+            if _EMBEDDING_MODEL is None:
+                model_name = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+                
+                model_kwargs = {}
+                
+                # Optional inference backend ("onnx" or "openvino"); "torch" is the default
+                backend = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+                if backend != "torch":
+                    model_kwargs["backend"] = backend
+                
+                # Optional Matryoshka truncation to store narrower vectors (must match schema.sql)
+                embedding_dim = os.getenv("EMBEDDING_DIM")
+                if embedding_dim:
+                    model_kwargs["truncate_dim"] = int(embedding_dim)
+                
+                _EMBEDDING_MODEL = SentenceTransformer(model_name, **model_kwargs)
+    return _EMBEDDING_MODEL
+
+def _to_pgvector(embedding) -> str:
+    """Format an embedding as pgvector's text literal with 6 significant digits.
     
-    return create_client(supabase_url, supabase_key)
+    Roughly half the size of a JSON list of full-precision floats, and float32
+    embeddings carry no more precision than that anyway.
+    """
+    return "[" + ",".join(map("{:.6g}".format, embedding.tolist())) + "]"
 
 class MemoryManager:
-    def __init__(self):
-        """Initialize the memory manager with embedding model"""
-        model_name = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
-        self.embedding_model = SentenceTransformer(model_name)
+    @property
+    def embedding_model(self) -> SentenceTransformer:
+        """Embedding model shared across all memory managers"""
+        return get_embedding_model()
+    
+    def _encode(self, contents):
+        """Embed a text (or list of texts) with the shared model, reusing cached embeddings"""
+        single = isinstance(contents, str)
+        texts = [contents] if single else list(contents)
+        keys = [hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest() for text in texts]
+        embeddings = [None] * len(texts)
+        
+        with _EMBEDDING_CACHE_LOCK:
+            for i, key in enumerate(keys):
+                cached = _EMBEDDING_CACHE.get(key)
+                if cached is not None:
+                    _EMBEDDING_CACHE.move_to_end(key)
+                    embeddings[i] = cached
+        
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            model = self.embedding_model
+            
+            # Truncated embeddings are re-normalized so inner-product search stays a cosine match
+            normalize = getattr(model, "truncate_dim", None) is not None
+            encoded = model.encode([texts[i] for i in missing], batch_size=64,
+                                   show_progress_bar=False, normalize_embeddings=normalize)
+            
+            with _EMBEDDING_CACHE_LOCK:
+                for i, embedding in zip(missing, encoded):
+                    embeddings[i] = embedding
+                    _EMBEDDING_CACHE[keys[i]] = embedding
+                while len(_EMBEDDING_CACHE) > _EMBEDDING_CACHE_SIZE:
+                    _EMBEDDING_CACHE.popitem(last=False)
+        
+        return embeddings[0] if single else embeddings
     
     def add_message(self, user_id: str, role: str, content: str, conversation_id: str) -> bool:
         """Add a message to memory with embedding"""
@@ -28,7 +126,7 @@ class MemoryManager:
             supabase = get_supabase_client()
             
             # Generate embedding
-            embedding = self.embedding_model.encode(content).tolist()
+            embedding = _to_pgvector(self._encode(content))
             
             # Store in database
             result = supabase.table("memory_vectors").insert({
@@ -41,8 +139,39 @@ class MemoryManager:
             
             return bool(result.data)
             
-        except Exception as e:
-            print(f"Error adding message to memory: {e}")
+        except Exception:
+            logger.exception("Error adding message to memory", extra={"user_id": user_id, "conversation_id": conversation_id})
+            return False
+    
+    def add_messages(self, user_id: str, messages: List[Dict[str, str]], conversation_id: str) -> bool:
+        """Add several messages to memory with one batched embedding pass and a single insert"""
+        if not messages:
+            return True
+        
+        try:
+            supabase = get_supabase_client()
+            
+            # Generate all embeddings in one call (encode() length-sorts internally to minimize padding;
+            # texts already in the embedding cache are skipped)
+            contents = [msg["content"] for msg in messages]
+            embeddings = self._encode(contents)
+            
+            # Store in database with a single multi-row insert
+            result = supabase.table("memory_vectors").insert([
+                {
+                    "user_id": user_id,
+                    "role": msg["role"],
+                    "content": msg["content"],
+                    "conversation_id": conversation_id,
+                    "embedding": _to_pgvector(embedding)
+                }
+                for msg, embedding in zip(messages, embeddings)
+            ]).execute()
+            
+            return bool(result.data)
+            
+        except Exception:
+            logger.exception("Error adding messages to memory", extra={"user_id": user_id, "conversation_id": conversation_id})
             return False
     
     def recall(self, user_id: str, query: str, k: int = 4, conversation_id: Optional[str] = None) -> List[Dict[str, Any]]:
@@ -51,7 +180,7 @@ class MemoryManager:
             supabase = get_supabase_client()
             
             # Generate query embedding
-            query_embedding = self.embedding_model.encode(query).tolist()
+            query_embedding = _to_pgvector(self._encode(query))
             
             # Use the RPC function for similarity search
             result = supabase.rpc("match_memory_vectors", {
@@ -64,28 +193,75 @@ class MemoryManager:
             
             return result.data or []
             
-        except Exception as e:
-            print(f"Error recalling context: {e}")
+        except Exception:
+            logger.exception("Error recalling context", extra={"user_id": user_id, "conversation_id": conversation_id})
             return []
     
-    def get_conversation_messages(self, user_id: str, conversation_id: str, limit: int = 50) -> List[Dict[str, Any]]:
-        """Get recent messages from a conversation"""
+    def add_messages_async(self, user_id: str, messages: List[Dict[str, str]], conversation_id: str) -> Future:
+        """Run add_messages on the memory I/O pool; the future resolves to its result"""
+        return _MEMORY_IO_POOL.submit(self.add_messages, user_id, messages, conversation_id)
+    
+    def lookup_cached_response(self, user_id: str, provider: str, model: str, prompt: str,
+                               threshold: float = 0.92) -> Optional[str]:
+        """Return a cached response for a semantically similar prompt, if any"""
         try:
             supabase = get_supabase_client()
             
+            result = supabase.rpc("match_response_cache", {
+                "query_embedding": _to_pgvector(self._encode(prompt)),
+                "match_threshold": threshold,
+                "match_count": 1,
+                "p_user_id": user_id,
+                "p_provider": provider,
+                "p_model": model
+            }).execute()
+            
+            return result.data[0]["response"] if result.data else None
+            
+        except Exception:
+            logger.exception("Error looking up cached response", extra={"user_id": user_id})
+            return None
+    
+    def store_cached_response(self, user_id: str, provider: str, model: str, prompt: str, response: str) -> bool:
+        """Store a response in the semantic response cache"""
+        try:
+            supabase = get_supabase_client()
+            
+            result = supabase.table("response_cache").insert({
+                "user_id": user_id,
+                "provider": provider,
+                "model": model,
+                "prompt": prompt,
+                "response": response,
+                "embedding": _to_pgvector(self._encode(prompt))
+            }).execute()
+            
+            return bool(result.data)
+            
+        except Exception:
+            logger.exception("Error storing cached response", extra={"user_id": user_id})
+            return False
+    
+    def get_conversation_messages(self, user_id: str, conversation_id: str,
+                                  limit: int = 50) -> Tuple[List[Dict[str, Any]], int]:
+        """Get the oldest messages from a conversation (up to limit) and the conversation's total message count"""
+        try:
+            supabase = get_supabase_client()
+            
+            # count="exact" returns the total alongside the rows in the same request
             result = supabase.table("memory_vectors")\
-                .select("*")\
+                .select("*", count="exact")\
                 .eq("user_id", user_id)\
                 .eq("conversation_id", conversation_id)\
                 .order("created_at", desc=False)\
                 .limit(limit)\
                 .execute()
             
-            return result.data or []
+            return result.data or [], result.count or 0
             
-        except Exception as e:
-            print(f"Error getting conversation messages: {e}")
-            return []
+        except Exception:
+            logger.exception("Error getting conversation messages", extra={"user_id": user_id, "conversation_id": conversation_id})
+            return [], 0
     
     def delete_conversation(self, user_id: str, conversation_id: str) -> bool:
         """Delete all messages from a conversation"""
@@ -100,8 +276,8 @@ class MemoryManager:
             
             return True
             
-        except Exception as e:
-            print(f"Error deleting conversation: {e}")
+        except Exception:
+            logger.exception("Error deleting conversation", extra={"user_id": user_id, "conversation_id": conversation_id})
             return False
     
     def summarize_conversation(self, user_id: str, conversation_id: str, summary: str, message_count: int) -> bool:
@@ -118,26 +294,41 @@ class MemoryManager:
             
             return bool(result.data)
             
-        except Exception as e:
-            print(f"Error storing summary: {e}")
+        except Exception:
+            logger.exception("Error storing summary", extra={"user_id": user_id, "conversation_id": conversation_id})
             return False
     
-    def get_user_conversations(self, user_id: str) -> List[str]:
-        """Get list of conversation IDs for a user"""
+    def get_latest_summary(self, user_id: str, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """Get the most recent summary of a conversation"""
         try:
             supabase = get_supabase_client()
             
-            result = supabase.table("memory_vectors")\
-                .select("conversation_id")\
+            result = supabase.table("summaries")\
+                .select("summary, messages_count")\
                 .eq("user_id", user_id)\
+                .eq("conversation_id", conversation_id)\
+                .order("created_at", desc=True)\
+                .limit(1)\
                 .execute()
             
-            # Get unique conversation IDs
-            conversation_ids = list(set(item["conversation_id"] for item in result.data if item.get("conversation_id")))
-            return conversation_ids
+            return result.data[0] if result.data else None
             
-        except Exception as e:
-            print(f"Error getting user conversations: {e}")
+        except Exception:
+            logger.exception("Error getting latest summary", extra={"user_id": user_id, "conversation_id": conversation_id})
+            return None
+    
+    def get_user_conversations(self, user_id: str) -> List[str]:
+        """Get list of conversation IDs for a user"""
+        try:
+            supabase = get_supabase_client()
+            
+            # DISTINCT runs in Postgres, so one row per conversation comes back instead of per message
+            result = supabase.rpc("distinct_conversations", {"p_user_id": user_id}).execute()
+            
+            return [item["conversation_id"] for item in result.data or []]
+            
+        except Exception:
+            logger.exception("Error getting user conversations", extra={"user_id": user_id})
             return []
     
     def count_messages(self, user_id: str, conversation_id: str) -> int:
@@ -145,18 +336,36 @@ class MemoryManager:
         try:
             supabase = get_supabase_client()
             
+            # HEAD request: PostgREST returns only the exact count, no rows
             result = supabase.table("memory_vectors")\
-                .select("id", count="exact")\
+                .select("id", count="exact", head=True)\
                 .eq("user_id", user_id)\
                 .eq("conversation_id", conversation_id)\
                 .execute()
             
-            return result.count if result.count else 0
+            return result.count or 0
             
-        except Exception as e:
-            print(f"Error counting messages: {e}")
+        except Exception:
+            logger.exception("Error counting messages", extra={"user_id": user_id, "conversation_id": conversation_id})
             return 0
     
+    def summarize_and_prune_async(self, user_id: str, conversation_id: str, llm_bridge, provider: str, model: str, api_key: str) -> Optional[Future]:
+        """Run summarize_and_prune in the background; returns None if one is already running for the conversation"""
+        key = (user_id, conversation_id)
+        with _SUMMARIES_IN_FLIGHT_LOCK:
+            if key in _SUMMARIES_IN_FLIGHT:
+                return None
+            _SUMMARIES_IN_FLIGHT.add(key)
+        
+        def run() -> bool:
+            try:
+                return self.summarize_and_prune(user_id, conversation_id, llm_bridge, provider, model, api_key)
+            finally:
+                with _SUMMARIES_IN_FLIGHT_LOCK:
+                    _SUMMARIES_IN_FLIGHT.discard(key)
+        
+        return _SUMMARY_POOL.submit(run)
+    
     def summarize_and_prune(self, user_id: str, conversation_id: str, llm_bridge, provider: str, model: str, api_key: str) -> bool:
         """Summarize old messages and prune vectors"""
         try:
@@ -165,38 +374,68 @@ class MemoryManager:
                 return False
             
             # Get messages older than last 10
-            messages = self.get_conversation_messages(user_id, conversation_id, limit=100)
+            messages, message_count = self.get_conversation_messages(user_id, conversation_id, limit=100)
             
-            if len(messages) < 20:
+            if message_count < 20:
                 return False
             
-            # Take messages except the last 10
+            # Take messages except the last 10. Summarized messages are pruned below,
+            # so everything left here is new since the previous summary.
             messages_to_summarize = messages[:-10]
             
-            # Create summary prompt
-            conversation_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages_to_summarize])
-            summary_prompt = f"Please provide a concise summary of the following conversation:\n\n{conversation_text}"
+            # Create summary prompt, oldest first, stopping at the token budget. Messages past
+            # the budget stay stored and are picked up by the next summary.
+            budget = _SUMMARY_INPUT_TOKEN_BUDGET
+            token_counter = get_token_counter()
+            lines = []
+            for msg in messages_to_summarize:
+                line = f"{msg['role']}: {msg['content']}"
+                budget -= token_counter.count_tokens(provider, model, line)
+                if budget < 0 and lines:
+                    break
+                lines.append(line)
+            messages_to_summarize = messages_to_summarize[:len(lines)]
+            conversation_text = "\n".join(lines)
+            
+            # Roll the previous summary forward instead of re-summarizing the whole history.
+            # It goes first as a system message so repeated jobs share a stable prompt prefix.
+            previous = self.get_latest_summary(user_id, conversation_id)
+            summary_messages = []
+            if previous:
+                summary_messages.append({
+                    "role": "system",
+                    "content": f"Summary of the conversation so far:\n\n{previous['summary']}"
+                })
+                summary_prompt = f"Please update the summary above with the following new messages, keeping it concise:\n\n{conversation_text}"
+            else:
+                summary_prompt = f"Please provide a concise summary of the following conversation:\n\n{conversation_text}"
             
             # Generate summary using LLM
-            summary_messages = [{"role": "user", "content": summary_prompt}]
+            summary_messages.append({"role": "user", "content": summary_prompt})
             response = llm_bridge.chat(provider, model, api_key, summary_messages, temperature=0.3, max_tokens=500)
             summary = llm_bridge.extract_content(provider, response)
             
-            # Store summary
-            self.summarize_conversation(user_id, conversation_id, summary, len(messages_to_summarize))
+            # Store summary with the cumulative count of messages it covers; the insert
+            # and the delete below are independent, so they run concurrently
+            messages_count = len(messages_to_summarize) + (previous["messages_count"] if previous else 0)
+            summary_write = _MEMORY_IO_POOL.submit(
+                self.summarize_conversation, user_id, conversation_id, summary, messages_count
+            )
             
-            # Delete old vectors (keep last 10 messages)
+            # Delete exactly the summarized vectors (the last 10 messages and anything over budget
+            # are kept). By id, not created_at: rows of one insert can share a timestamp, and the
+            # budget cut can fall between them.
             if len(messages_to_summarize) > 0:
-                oldest_timestamp = messages_to_summarize[-1]['created_at']
                 supabase.table("memory_vectors")\
                     .delete()\
                     .eq("user_id", user_id)\
                     .eq("conversation_id", conversation_id)\
-                    .lte("created_at", oldest_timestamp)\
+                    .in_("id", [msg["id"] for msg in messages_to_summarize])\
                     .execute()
             
+            summary_write.result()
             return True
             
-        except Exception as e:
-            print(f"Error in summarize_and_prune: {e}")
+        except Exception:
+            logger.exception("Error in summarize_and_prune", extra={"user_id": user_id, "conversation_id": conversation_id})
             return False
\ No newline at end of file
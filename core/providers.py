@@ -1,8 +1,56 @@
 import openai
 import anthropic
 import google.generativeai as genai
-from typing import List, Dict, Any, Iterator
+from typing import List, Dict, Any, Callable, Iterator, Optional
+import contextlib
+import functools
 import json
+import os
+import threading
+
+# genai.configure() sets process-wide state, so the active key and the number of Gemini
+# requests currently being sent under it are tracked at module level
+_GEMINI_API_KEY: Optional[str] = None
+_GEMINI_REQUESTS_IN_FLIGHT = 0
+_GEMINI_CONDITION = threading.Condition()
+
+@functools.lru_cache(maxsize=16)
+def _openai_client(api_key: str) -> openai.OpenAI:
+    """OpenAI client per API key, reused so keep-alive connections skip the TLS handshake"""
+    return openai.OpenAI(api_key=api_key, http_client=openai.DefaultHttpxClient(http2=True))
+
+@functools.lru_cache(maxsize=16)
+def _anthropic_client(api_key: str) -> anthropic.Anthropic:
+    """Anthropic client per API key, reused so keep-alive connections skip the TLS handshake"""
+    return anthropic.Anthropic(api_key=api_key, http_client=anthropic.DefaultHttpxClient(http2=True))
+
+@contextlib.contextmanager
+def _gemini_api_key(api_key: str) -> Iterator[None]:
+    """Send Gemini requests under api_key: requests with the same key run concurrently, while
+    switching to another key waits until no request is still being sent under the current one"""
+    global _GEMINI_API_KEY, _GEMINI_REQUESTS_IN_FLIGHT
+    with _GEMINI_CONDITION:
+        while _GEMINI_REQUESTS_IN_FLIGHT and _GEMINI_API_KEY != api_key:
+            _GEMINI_CONDITION.wait()
+        if _GEMINI_API_KEY != api_key:
+            genai.configure(api_key=api_key)
+            _GEMINI_API_KEY = api_key
+        _GEMINI_REQUESTS_IN_FLIGHT += 1
+    try:
+        yield
+    finally:
+        with _GEMINI_CONDITION:
+            _GEMINI_REQUESTS_IN_FLIGHT -= 1
+            if not _GEMINI_REQUESTS_IN_FLIGHT:
+                _GEMINI_CONDITION.notify_all()
+
+class CachedResponse:
+    """Response served from the semantic response cache instead of a provider call"""
+    
+    from_cache = True
+    
+    def __init__(self, text: str):
+        self.text = text
 
 class LLMBridge:
     """Bridge class to handle multiple LLM providers"""
@@ -56,6 +104,13 @@ class LLMBridge:
                 "default_model": "gemini-2.5-pro"
             }
         }
+        
+        # Provider name -> request handler, used by chat()
+        self._chat_handlers = {
+            "OpenAI": self._chat_openai,
+            "Anthropic": self._chat_anthropic,
+            "Gemini": self._chat_gemini
+        }
     
     def get_available_models(self, provider: str) -> List[str]:
         """Get available models for a provider"""
@@ -69,19 +124,64 @@ class LLMBridge:
              temperature: float = 0.7, max_tokens: int = 1000, stream: bool = False) -> Any:
         """Send chat request to specified provider"""
         
-        if provider == "OpenAI":
-            return self._chat_openai(api_key, model, messages, temperature, max_tokens, stream)
-        elif provider == "Anthropic":
-            return self._chat_anthropic(api_key, model, messages, temperature, max_tokens, stream)
-        elif provider == "Gemini":
-            return self._chat_gemini(api_key, model, messages, temperature, max_tokens, stream)
-        else:
+        handler = self._chat_handlers.get(provider)
+        if handler is None:
             raise ValueError(f"Unsupported provider: {provider}")
+        
+        return handler(api_key, model, messages, temperature, max_tokens, stream)
+    
+    def chat_cached(self, provider: str, model: str, api_key: str, messages: List[Dict[str, str]],
+                    memory_manager, user_id: str, temperature: float = 0.7, max_tokens: int = 1000,
+                    stream: bool = False) -> Any:
+        """Send chat request, answering standalone prompts from the semantic cache when enabled"""
+        # Only opening prompts are cached: later turns depend on the conversation so far
+        is_standalone = not any(msg["role"] == "assistant" for msg in messages)
+        use_cache = (os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+                     and is_standalone and messages and messages[-1]["role"] == "user")
+        
+        if not use_cache:
+            return self.chat(provider, model, api_key, messages, temperature, max_tokens, stream)
+        
+        prompt = messages[-1]["content"]
+        threshold = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+        
+        cached = memory_manager.lookup_cached_response(user_id, provider, model, prompt, threshold)
+        if cached is not None:
+            return CachedResponse(cached)
+        
+        response = self.chat(provider, model, api_key, messages, temperature, max_tokens, stream)
+        
+        if stream:
+            # Pass chunks through unchanged and store the reply once the stream is consumed
+            return self._cache_stream(provider, response, lambda text: memory_manager.store_cached_response(
+                user_id, provider, model, prompt, text
+            ))
+        
+        # Only real answers are cached; an empty or unreadable reply would be replayed to similar prompts
+        try:
+            content = self._response_text(provider, response)
+        except Exception:
+            content = ""
+        if content:
+            memory_manager.store_cached_response(user_id, provider, model, prompt, content)
+        return response
+    
+    def _cache_stream(self, provider: str, response: Any, store: Callable[[str], Any]) -> Iterator[Any]:
+        """Yield stream chunks as-is, then hand the accumulated reply text to store if the stream completed with any"""
+        parts = []
+        for chunk in response:
+            parts.append(self.extract_stream_content(provider, chunk))
+            yield chunk
+        
+        # Not reached if the stream raised; empty replies are not cached either
+        text = "".join(parts)
+        if text:
+            store(text)
     
     def _chat_openai(self, api_key: str, model: str, messages: List[Dict[str, str]], 
                      temperature: float, max_tokens: int, stream: bool) -> Any:
         """Handle OpenAI chat requests"""
-        client = openai.OpenAI(api_key=api_key)
+        client = _openai_client(api_key)
         
         try:
             response = client.chat.completions.create(
@@ -98,7 +198,7 @@ class LLMBridge:
     def _chat_anthropic(self, api_key: str, model: str, messages: List[Dict[str, str]], 
                         temperature: float, max_tokens: int, stream: bool) -> Any:
         """Handle Anthropic chat requests"""
-        client = anthropic.Anthropic(api_key=api_key)
+        client = _anthropic_client(api_key)
         
         # Convert messages format for Anthropic
         system_message = ""
@@ -129,29 +229,32 @@ class LLMBridge:
     def _chat_gemini(self, api_key: str, model: str, messages: List[Dict[str, str]], 
                      temperature: float, max_tokens: int, stream: bool) -> Any:
         """Handle Gemini chat requests"""
-        genai.configure(api_key=api_key)
-        model_instance = genai.GenerativeModel(model)
+        # Gemini takes system prompts as a model setting and calls the assistant role "model"
+        system_instruction = "\n\n".join(msg["content"] for msg in messages if msg["role"] == "system")
+        history = [
+            {"role": "model" if msg["role"] == "assistant" else "user", "parts": [msg["content"]]}
+            for msg in messages
+            if msg["role"] in ("user", "assistant")
+        ]
         
-        # Convert messages to Gemini format
-        conversation = []
-        for msg in messages:
-            if msg["role"] == "user":
-                conversation.append(msg["content"])
-            elif msg["role"] == "assistant":
-                conversation.append(msg["content"])
+        model_instance = genai.GenerativeModel(model, system_instruction=system_instruction or None)
         
-        # Use the last user message as the prompt
-        prompt = conversation[-1] if conversation else ""
+        # Earlier turns become the chat history; the last message is the prompt
+        prompt = history.pop()["parts"][0] if history else ""
+        chat = model_instance.start_chat(history=history)
         
         try:
-            response = model_instance.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=temperature,
-                    max_output_tokens=max_tokens
-                ),
-                stream=stream
-            )
+            # The model binds the configured client during send_message (which also waits for
+            # the first chunk when streaming), so the key has to stay in place until it returns
+            with _gemini_api_key(api_key):
+                response = chat.send_message(
+                    prompt,
+                    generation_config=genai.types.GenerationConfig(
+                        temperature=temperature,
+                        max_output_tokens=max_tokens
+                    ),
+                    stream=stream
+                )
             return response
         except Exception as e:
             raise Exception(f"Gemini API error: {str(e)}")
@@ -159,17 +262,30 @@ class LLMBridge:
     def extract_content(self, provider: str, response: Any) -> str:
         """Extract content from provider response"""
         try:
-            if provider == "OpenAI":
-                return response.choices[0].message.content
-            elif provider == "Anthropic":
-                return response.content[0].text
-            elif provider == "Gemini":
-                return response.text
-            else:
-                return str(response)
+            return self._response_text(provider, response)
         except Exception as e:
             return f"Error extracting content: {str(e)}"
     
+    def _response_text(self, provider: str, response: Any) -> str:
+        """Reply text of a non-streaming response; raises if the response has none"""
+        if isinstance(response, CachedResponse):
+            return response.text
+        elif provider == "OpenAI":
+            return response.choices[0].message.content or ""
+        elif provider == "Anthropic":
+            return response.content[0].text
+        elif provider == "Gemini":
+            return response.text
+        else:
+            return str(response)
+    
+    def stream_text(self, provider: str, response: Any) -> Iterator[str]:
+        """Yield the non-empty text deltas from a streaming response"""
+        for chunk in response:
+            text = self.extract_stream_content(provider, chunk)
+            if text:
+                yield text
+    
     def extract_stream_content(self, provider: str, chunk: Any) -> str:
         """Extract content from streaming response chunk"""
         try:
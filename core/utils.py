@@ -1,20 +1,79 @@
+import atexit
 import json
+import logging
+import logging.handlers
+import queue
+import re
 import uuid
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 import os
-from supabase import create_client, Client
 
-def get_supabase_client():
-    """Get Supabase client with lazy initialization"""
-    supabase_url = os.getenv("SUPABASE_URL")
-    supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+logger = logging.getLogger(__name__)
+
+# Background listener that writes queued log records, started by setup_logging()
+_LOG_LISTENER: Optional[logging.handlers.QueueListener] = None
+
+# Filename sanitization patterns, compiled once at import
+_INVALID_FILENAME_CHARS = re.compile(r'[<>:"/\\|?*]')
+_REPEATED_UNDERSCORES = re.compile(r'_+')
+
+# Provider-specific API key format checks used by validate_api_key
+_API_KEY_VALIDATORS = {
+    "OpenAI": lambda key: key.startswith("sk-"),
+    "Anthropic": lambda key: key.startswith("sk-ant-"),
+    "Gemini": lambda key: len(key) > 20  # Basic length check
+}
+
+class _LogContextFilter(logging.Filter):
+    """Give every record the user_id / conversation_id fields the formatter prints"""
     
-    if not supabase_url or not supabase_key:
-        # Return None if credentials not available (for testing)
-        return None
+    def filter(self, record: logging.LogRecord) -> bool:
+        for field in ("user_id", "conversation_id"):
+            if not hasattr(record, field):
+                setattr(record, field, "-")
+        return True
+
+def setup_logging():
+    """Route log records through a queue so request threads never block on log I/O.
     
-    return create_client(supabase_url, supabase_key)
+    Safe to call on every Streamlit rerun; the listener is only started once per process.
+    """
+    global _LOG_LISTENER
+    if _LOG_LISTENER is not None:
+        return
+    
+    # Context passed as extra={"user_id": ..., "conversation_id": ...} is written with each line
+    handler = logging.StreamHandler()
+    handler.addFilter(_LogContextFilter())
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s [user=%(user_id)s conversation=%(conversation_id)s]: %(message)s"
+    ))
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    
+    # httpx/httpcore log every Supabase and provider request at INFO
+    for name in ("httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    
+    _LOG_LISTENER = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _LOG_LISTENER.start()
+    atexit.register(_LOG_LISTENER.stop)
+
+def get_supabase_client():
+    """Get the shared service-role Supabase client, or None if credentials are not set"""
+    # Imported here: app.py imports this module before load_dotenv(), and core.auth reads
+    # its settings at import time
+    from core.auth import get_service_client
+    try:
+        # Cached in core.auth, so analytics writes reuse one pooled connection
+        return get_service_client()
+    except ValueError:
+        # Credentials not available (for testing)
+        return None
 
 def generate_conversation_id() -> str:
     """Generate a unique conversation ID"""
@@ -25,20 +84,23 @@ def format_chat_history_for_export(history: List[Dict[str, Any]], format_type: s
     if format_type == "json":
         return json.dumps(history, indent=2, ensure_ascii=False)
     elif format_type == "md":
-        md_content = "# Chat History\n\n"
-        md_content += f"*Exported on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}*\n\n"
+        # Collect the pieces and join once; repeated += on a str re-copies the whole export
+        parts = [
+            "# Chat History\n\n",
+            f"*Exported on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}*\n\n"
+        ]
         
         for message in history:
             role = message.get("role", "").title()
             content = message.get("content", "")
             timestamp = message.get("timestamp", "")
             
-            md_content += f"## {role}\n"
+            parts.append(f"## {role}\n")
             if timestamp:
-                md_content += f"*{timestamp}*\n\n"
-            md_content += f"{content}\n\n---\n\n"
+                parts.append(f"*{timestamp}*\n\n")
+            parts.append(f"{content}\n\n---\n\n")
         
-        return md_content
+        return "".join(parts)
     else:
         return str(history)
 
@@ -66,103 +128,64 @@ def log_analytics(user_id: int, provider: str, model: str, prompt_tokens: int,
         result = supabase.table('analytics').insert(data).execute()
         return len(result.data) > 0
         
-    except Exception as e:
-        print(f"Error logging analytics: {e}")
+    except Exception:
+        logger.exception("Error logging analytics", extra={"user_id": user_id, "conversation_id": conversation_id})
         return False
 
-def get_user_stats(user_id: int, days: int = 30) -> Dict[str, Any]:
+def get_user_stats(user_id: str, days: int = 30) -> Dict[str, Any]:
     """Get user statistics for the last N days"""
+    empty_stats = {
+        "total_requests": 0,
+        "total_tokens": 0,
+        "total_cost": 0.0,
+        "favorite_provider": "None",
+        "favorite_model": "None"
+    }
+    
     try:
         supabase = get_supabase_client()
         if not supabase:
-            return {
-                "total_requests": 0,
-                "total_tokens": 0,
-                "total_cost": 0.0,
-                "favorite_provider": "None",
-                "favorite_model": "None"
-            }
-        
-        # Calculate date threshold
-        from datetime import timedelta
-        threshold_date = (datetime.now() - timedelta(days=days)).isoformat()
-        
-        # Get user analytics
-        result = supabase.table('analytics')\
-            .select('*')\
-            .eq('user_id', user_id)\
-            .gte('created_at', threshold_date)\
-            .execute()
-        
-        if not result.data:
-            return {
-                "total_requests": 0,
-                "total_tokens": 0,
-                "total_cost": 0.0,
-                "favorite_provider": "None",
-                "favorite_model": "None"
-            }
+            return empty_stats
         
-        data = result.data
+        # Totals and favorites are aggregated by the user_stats() SQL function,
+        # so a single row comes back instead of every analytics record
+        result = supabase.rpc('user_stats', {
+            'p_user_id': user_id,
+            'p_days': days
+        }).execute()
         
-        # Calculate statistics
-        total_requests = len(data)
-        total_tokens = sum(row['total_tokens'] for row in data)
-        total_cost = sum(row['estimated_cost'] for row in data)
+        if not result.data or not result.data[0]['total_requests']:
+            return empty_stats
         
-        # Find favorite provider and model
-        providers = {}
-        models = {}
-        
-        for row in data:
-            provider = row['provider']
-            model = row['model']
-            
-            providers[provider] = providers.get(provider, 0) + 1
-            models[model] = models.get(model, 0) + 1
-        
-        favorite_provider = max(providers.items(), key=lambda x: x[1])[0] if providers else "None"
-        favorite_model = max(models.items(), key=lambda x: x[1])[0] if models else "None"
+        stats = result.data[0]
         
         return {
-            "total_requests": total_requests,
-            "total_tokens": total_tokens,
-            "total_cost": round(total_cost, 4),
-            "favorite_provider": favorite_provider,
-            "favorite_model": favorite_model
+            "total_requests": stats['total_requests'],
+            "total_tokens": stats['total_tokens'],
+            "total_cost": round(float(stats['total_cost']), 4),
+            "favorite_provider": stats['favorite_provider'] or "None",
+            "favorite_model": stats['favorite_model'] or "None"
         }
         
-    except Exception as e:
-        print(f"Error getting user stats: {e}")
-        return {
-            "total_requests": 0,
-            "total_tokens": 0,
-            "total_cost": 0.0,
-            "favorite_provider": "None",
-            "favorite_model": "None"
-        }
+    except Exception:
+        logger.exception("Error getting user stats", extra={"user_id": user_id})
+        return empty_stats
 
 def validate_api_key(provider: str, api_key: str) -> bool:
     """Basic API key validation"""
     if not api_key or len(api_key.strip()) < 10:
         return False
     
-    if provider == "OpenAI":
-        return api_key.startswith("sk-")
-    elif provider == "Anthropic":
-        return api_key.startswith("sk-ant-")
-    elif provider == "Gemini":
-        return len(api_key) > 20  # Basic length check
-    
-    return True
+    # Unknown providers only get the length check above
+    validator = _API_KEY_VALIDATORS.get(provider)
+    return validator(api_key) if validator else True
 
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename for export"""
-    import re
     # Remove invalid characters
-    filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
+    filename = _INVALID_FILENAME_CHARS.sub('_', filename)
     # Remove multiple underscores
-    filename = re.sub(r'_+', '_', filename)
+    filename = _REPEATED_UNDERSCORES.sub('_', filename)
     # Remove leading/trailing underscores
     filename = filename.strip('_')
     
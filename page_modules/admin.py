@@ -1,24 +1,99 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-import plotly.graph_objects as go
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
 import os
+import time
 from supabase import create_client, Client
 
-# Initialize Supabase client
-supabase: Client = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-)
+@st.cache_resource(show_spinner=False)
+def _supabase() -> Client:
+    """Service-role Supabase client, created on first use and shared across reruns and sessions"""
+    supabase_url = os.getenv("SUPABASE_URL")
+    supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    
+    if not supabase_url or not supabase_key:
+        raise ValueError("Supabase URL and service role key must be set in environment variables")
+    
+    return create_client(supabase_url, supabase_key)
+
+# Dashboard data is cached per refresh bucket of this many seconds
+REFRESH_SECONDS = 30
+
+@st.cache_data(ttl=REFRESH_SECONDS, show_spinner=False)
+def _fetch_dashboard_data(days_back: int, bucket: int) -> Dict[str, pd.DataFrame]:
+    """Fetch dashboard aggregates for the period ending at the bucket boundary, plus all users"""
+    end_date = datetime.fromtimestamp(bucket * REFRESH_SECONDS, tz=timezone.utc)
+    start_date = end_date - timedelta(days=days_back)
+    
+    # All panels come from one admin_dashboard() call (one round trip, one scan of
+    # the window); the users list is fetched alongside it
+    dashboard_query = _supabase().rpc('admin_dashboard', {
+        'p_start': start_date.isoformat(),
+        'p_end': end_date.isoformat(),
+        'p_model_limit': 10,
+        'p_user_limit': 20,
+        'p_recent_limit': 50
+    })
+    
+    users_query = _supabase().table('users')\
+        .select('id, username, email, is_admin, created_at')
+    
+    # Run both queries concurrently (wall time is the slower query, not the sum)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        dashboard_future = pool.submit(dashboard_query.execute)
+        users_future = pool.submit(users_query.execute)
+        dashboard = dashboard_future.result().data or {}
+        users_data = users_future.result()
+    
+    frames = {name: pd.DataFrame(dashboard.get(name) or []) for name in ('daily', 'providers', 'models', 'top_users', 'recent')}
+    frames['overview'] = pd.DataFrame([dashboard['overview']]) if dashboard.get('overview') else pd.DataFrame()
+    frames['users'] = pd.DataFrame(users_data.data or [])
+    
+    # Daily buckets arrive as 'YYYY-MM-DD' strings; a datetime index gives the charts a time axis
+    if not frames['daily'].empty:
+        frames['daily']['date'] = pd.to_datetime(frames['daily']['date'])
+    
+    # Downcast the aggregate columns to the smallest int dtype that fits and float32 before caching
+    for name in ('daily', 'providers', 'models', 'top_users', 'recent'):
+        df = frames[name]
+        for column in df.columns.intersection(['requests', 'total_tokens']):
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+        if 'estimated_cost' in df.columns:
+            df['estimated_cost'] = pd.to_numeric(df['estimated_cost'], downcast='float')
+    
+    # Parse signup times once here (cached with the data) rather than per use on every rerun;
+    # the raw timestamp strings are not used after that
+    if not frames['users'].empty:
+        frames['users']['created_at_dt'] = pd.to_datetime(frames['users']['created_at'], utc=True, format='ISO8601')
+        frames['users'] = frames['users'].drop(columns='created_at')
+        frames['users']['is_admin'] = frames['users']['is_admin'].astype('bool')
+    
+    return frames
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _is_admin(user_id: str) -> bool:
+    """Check admin status, cached for 5 minutes so reruns and refreshes skip the DB call.
+    
+    Errors propagate instead of reading as False, so a failed check is never cached.
+    """
+    from core.auth import is_admin
+    return is_admin(user_id, raise_errors=True)
 
 def show_admin_page():
     """Display the admin dashboard"""
     st.title("Admin Dashboard")
     
     # Check if user is admin
-    from core.auth import is_admin
-    if not is_admin(st.session_state.user_id):
+    try:
+        admin = _is_admin(st.session_state.user_id)
+    except Exception as e:
+        st.error(f"Could not verify admin privileges: {e}")
+        return
+    
+    if not admin:
         st.error("Access denied. Admin privileges required.")
         return
     
@@ -31,44 +106,38 @@ def show_admin_page():
     with col2:
         auto_refresh = st.checkbox("Auto-refresh (30s)", value=False)
     
-    if auto_refresh:
-        st.rerun()
-    
-    # Calculate date range
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=days_back)
-    
-    # Fetch analytics data
+    # Only the dashboard fragment reruns on the timer; the controls above stay interactive
+    # and nothing blocks the script thread between refreshes
+    dashboard = st.fragment(_show_dashboard, run_every=REFRESH_SECONDS if auto_refresh else None)
+    dashboard(days_back)
+
+def _show_dashboard(days_back: int):
+    """Render the dashboard panels for the selected period"""
+    # Reruns within the same 30s bucket reuse the cached query results
     try:
-        analytics_data = supabase.table('analytics')\
-            .select('*')\
-            .gte('created_at', start_date.isoformat())\
-            .lte('created_at', end_date.isoformat())\
-            .execute()
-        
-        users_data = supabase.table('users')\
-            .select('id, username, email, is_admin, created_at')\
-            .execute()
-        
-        df_analytics = pd.DataFrame(analytics_data.data) if analytics_data.data else pd.DataFrame()
-        df_users = pd.DataFrame(users_data.data) if users_data.data else pd.DataFrame()
-        
+        data = _fetch_dashboard_data(days_back, int(time.time() // REFRESH_SECONDS))
+        df_users = data['users']
     except Exception as e:
         st.error(f"Error fetching data: {e}")
         return
     
-    if df_analytics.empty and df_users.empty:
+    usernames = dict(zip(df_users['id'], df_users['username'])) if not df_users.empty else {}
+    
+    overview = data['overview'].iloc[0] if not data['overview'].empty else None
+    has_analytics = overview is not None and overview['total_requests'] > 0
+    
+    if not has_analytics and df_users.empty:
         st.warning("No data available. The dashboard will populate as users interact with the chatbot.")
         return
     
     # Overview metrics
     st.subheader("📊 Overview")
     
-    if not df_analytics.empty:
-        total_requests = len(df_analytics)
-        total_tokens = df_analytics['total_tokens'].sum()
-        total_cost = df_analytics['estimated_cost'].sum()
-        unique_users = df_analytics['user_id'].nunique()
+    if has_analytics:
+        total_requests = int(overview['total_requests'])
+        total_tokens = int(overview['total_tokens'])
+        total_cost = float(overview['total_cost'])
+        unique_users = int(overview['unique_users'])
     else:
         total_requests = total_tokens = total_cost = unique_users = 0
     
@@ -83,43 +152,25 @@ def show_admin_page():
     with col4:
         st.metric("Active Users", unique_users)
     
-    if df_analytics.empty:
+    if not has_analytics:
         st.info("No analytics data available for the selected time period.")
         return
     
     # Daily activity chart
     st.subheader("📈 Daily Activity")
     
-    df_analytics['date'] = pd.to_datetime(df_analytics['created_at']).dt.date
-    daily_stats = df_analytics.groupby('date').agg({
-        'id': 'count',
-        'total_tokens': 'sum',
-        'estimated_cost': 'sum'
-    }).rename(columns={'id': 'requests'}).reset_index()
+    daily_stats = data['daily']
     
     col1, col2 = st.columns(2)
     
+    # Streamlit's native charts ship a compact Vega-Lite spec instead of a full Plotly figure
     with col1:
-        fig_requests = px.line(
-            daily_stats, 
-            x='date', 
-            y='requests',
-            title='Daily Requests',
-            markers=True
-        )
-        fig_requests.update_layout(height=400)
-        st.plotly_chart(fig_requests, use_container_width=True)
+        st.write("**Daily Requests**")
+        st.line_chart(daily_stats.set_index('date')[['requests']], height=400)
     
     with col2:
-        fig_tokens = px.line(
-            daily_stats, 
-            x='date', 
-            y='total_tokens',
-            title='Daily Token Usage',
-            markers=True
-        )
-        fig_tokens.update_layout(height=400)
-        st.plotly_chart(fig_tokens, use_container_width=True)
+        st.write("**Daily Token Usage**")
+        st.line_chart(daily_stats.set_index('date')[['total_tokens']], height=400)
     
     # Provider and model distribution
     st.subheader("🔍 Usage Distribution")
@@ -127,11 +178,9 @@ def show_admin_page():
     col1, col2 = st.columns(2)
     
     with col1:
-        provider_stats = df_analytics.groupby('provider').agg({
-            'id': 'count',
-            'total_tokens': 'sum'
-        }).rename(columns={'id': 'requests'}).reset_index()
+        provider_stats = data['providers']
         
+        # Streamlit has no native pie chart, so this one stays on Plotly
         fig_providers = px.pie(
             provider_stats, 
             values='requests', 
@@ -141,49 +190,24 @@ def show_admin_page():
         st.plotly_chart(fig_providers, use_container_width=True)
     
     with col2:
-        model_stats = df_analytics.groupby('model').agg({
-            'id': 'count',
-            'total_tokens': 'sum'
-        }).rename(columns={'id': 'requests'}).reset_index()
+        # Top 10 models (limited in SQL)
+        top_models = data['models']
         
-        # Top 10 models
-        top_models = model_stats.nlargest(10, 'requests')
-        
-        fig_models = px.bar(
-            top_models, 
-            x='requests', 
-            y='model',
-            title='Top 10 Models by Requests',
-            orientation='h'
-        )
-        fig_models.update_layout(height=400)
-        st.plotly_chart(fig_models, use_container_width=True)
+        st.write("**Top 10 Models by Requests**")
+        st.bar_chart(top_models.set_index('model')['requests'], horizontal=True, height=400)
     
     # User activity
     st.subheader("👥 User Activity")
     
-    user_stats = df_analytics.groupby('user_id').agg({
-        'id': 'count',
-        'total_tokens': 'sum',
-        'estimated_cost': 'sum'
-    }).rename(columns={'id': 'requests'}).reset_index()
+    user_stats = data['top_users']
     
-    # Merge with user info
-    if not df_users.empty:
-        user_stats = user_stats.merge(
-            df_users[['id', 'username']], 
-            left_on='user_id', 
-            right_on='id',
-            how='left'
-        )
-        user_stats['username'] = user_stats['username'].fillna('Unknown')
-    else:
-        user_stats['username'] = 'Unknown'
+    # Attach usernames with a plain id -> username lookup (only 20 rows need it)
+    user_stats['username'] = user_stats['user_id'].map(usernames).fillna('Unknown')
     
-    # Top users table
+    # Top users table (top 20, ordered in SQL)
     st.write("**Top Users by Activity**")
-    top_users = user_stats.nlargest(20, 'requests')[['username', 'requests', 'total_tokens', 'estimated_cost']]
-    top_users['estimated_cost'] = top_users['estimated_cost'].round(4)
+    top_users = user_stats[['username', 'requests', 'total_tokens', 'estimated_cost']].copy()
+    top_users['estimated_cost'] = top_users['estimated_cost'].astype(float).round(4)
     st.dataframe(top_users, use_container_width=True)
     
     # User list management
@@ -194,57 +218,36 @@ def show_admin_page():
         
         with col1:
             st.write("**All Users**")
-            user_display = df_users[['username', 'email', 'is_admin', 'created_at']].copy()
-            
-            # Fix datetime formatting by removing timezone info first
-            user_display['created_at'] = pd.to_datetime(user_display['created_at']).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
+            user_display = df_users[['username', 'email', 'is_admin']].copy()
+            user_display['created_at'] = df_users['created_at_dt'].dt.strftime('%Y-%m-%d')
             st.dataframe(user_display, use_container_width=True)
         
         with col2:
             st.write("**User Statistics**")
             total_users = len(df_users)
-            admin_users = df_users['is_admin'].sum()
+            # is_admin is a numpy bool column (cast in the fetch), so this is a vectorized count
+            admin_users = int(df_users['is_admin'].to_numpy().sum())
             
-            # Fix timezone issue for datetime comparison
-            seven_days_ago = datetime.now().replace(tzinfo=None) - timedelta(days=7)
-            user_created_dates = pd.to_datetime(df_users['created_at']).dt.tz_localize(None)
-            recent_users = len(df_users[user_created_dates > seven_days_ago])
+            # Both sides are UTC-aware, so no timezone stripping is needed
+            seven_days_ago = pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=7)
+            recent_users = int((df_users['created_at_dt'] > seven_days_ago).sum())
             
             st.metric("Total Users", total_users)
             st.metric("Admin Users", admin_users)
             st.metric("New Users (7 days)", recent_users)
     
-    # Recent activity log
+    # Recent activity log (latest 50 rows, only the displayed columns)
     st.subheader("📋 Recent Activity")
     
-    if not df_analytics.empty:
-        # Convert created_at to datetime for proper sorting
-        df_analytics['created_at_dt'] = pd.to_datetime(df_analytics['created_at'])
-        recent_activity = df_analytics.nlargest(50, 'created_at_dt')
-    else:
-        recent_activity = df_analytics
+    recent_activity = data['recent']
     
     if not recent_activity.empty and not df_users.empty:
-        recent_activity = recent_activity.merge(
-            df_users[['id', 'username']], 
-            left_on='user_id', 
-            right_on='id',
-            how='left'
-        )
-        recent_activity['username'] = recent_activity['username'].fillna('Unknown')
+        recent_activity['username'] = recent_activity['user_id'].map(usernames).fillna('Unknown')
         
+        # created_at is already formatted by admin_dashboard()
         activity_display = recent_activity[[
             'username', 'provider', 'model', 'total_tokens', 'estimated_cost', 'created_at'
         ]].copy()
-        
-        # Fix datetime formatting by removing timezone info first
-        activity_display['created_at'] = pd.to_datetime(activity_display['created_at']).dt.tz_localize(None).dt.strftime('%Y-%m-%d %H:%M:%S')
-        activity_display['estimated_cost'] = activity_display['estimated_cost'].round(4)
+        activity_display['estimated_cost'] = activity_display['estimated_cost'].astype(float).round(4)
         
         st.dataframe(activity_display, use_container_width=True)
-    
-    # Auto-refresh
-    if auto_refresh:
-        import time
-        time.sleep(30)
-        st.rerun()
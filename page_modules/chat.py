@@ -1,23 +1,57 @@
 import streamlit as st
+import hashlib
 import json
+import os
+from collections import deque
 from datetime import datetime
+from itertools import islice
 from core.providers import LLMBridge
 from core.memory import MemoryManager
-from core.counters import TokenCounter
+from core.counters import get_token_counter
+from core.auth import session_expired
 from core.utils import generate_conversation_id, format_chat_history_for_export, log_analytics, validate_api_key
 
+@st.cache_resource(show_spinner=False)
+def _get_bridge() -> LLMBridge:
+    """LLMBridge shared across reruns and sessions"""
+    return LLMBridge()
+
+@st.cache_resource(show_spinner=False)
+def _get_memory() -> MemoryManager:
+    """MemoryManager shared across reruns and sessions"""
+    return MemoryManager()
+
+# Messages kept in session state for display and export; older turns remain in memory storage
+HISTORY_LIMIT = int(os.getenv("CHAT_HISTORY_LIMIT", "200"))
+
+def _new_history() -> deque:
+    """Empty, bounded chat history"""
+    return deque(maxlen=HISTORY_LIMIT)
+
+def _append_history(message: dict):
+    """Append a message and roll it into the history digest that keys the export cache"""
+    st.session_state.history.append(message)
+    
+    # Chained hash of every (role, content, timestamp) appended since the history was created,
+    # so equal digests mean equal contents regardless of session, user or conversation ID
+    entry = json.dumps([message["role"], message["content"], message.get("timestamp", "")])
+    st.session_state.history_digest = hashlib.blake2b(
+        (st.session_state.history_digest + entry).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _export_history(history_digest: str, format_type: str, _history: deque) -> str:
+    """Export payload for the history contents identified by history_digest; _history itself is not hashed"""
+    return format_chat_history_for_export(list(_history), format_type)
+
 def show_chat_page():
     """Display the main chat interface"""
     st.title("🤖 AI Chatbot")
     
-    # Initialize components
-    llm_bridge = LLMBridge()
-    memory_manager = MemoryManager()
-    token_counter = TokenCounter()
-    
     # Initialize session state
     if 'history' not in st.session_state:
-        st.session_state.history = []
+        st.session_state.history = _new_history()
+        st.session_state.history_digest = ""
     
     if 'conversation_id' not in st.session_state:
         st.session_state.conversation_id = generate_conversation_id()
@@ -28,109 +62,98 @@ def show_chat_page():
     if 'total_cost' not in st.session_state:
         st.session_state.total_cost = 0.0
     
-    # Sidebar for configuration
+    # Each part reruns on its own: a sidebar tweak doesn't redraw the conversation,
+    # and sending a message doesn't rebuild the sidebar
     with st.sidebar:
-        st.header("⚙️ Configuration")
-        
-        # Provider selection
-        provider = st.selectbox(
-            "AI Provider",
-            ["OpenAI", "Anthropic", "Gemini"],
-            key="provider"
-        )
-        
-        # Model selection
-        available_models = llm_bridge.get_available_models(provider)
-        model = st.selectbox(
-            "Model",
-            available_models,
-            index=0 if available_models else 0,
-            key="model"
-        )
-        
-        # API Key input
-        api_key = st.text_input(
-            "API Key",
-            type="password",
-            placeholder=f"Enter your {provider} API key",
-            key="api_key"
-        )
-        
-        # Validate API key
-        if api_key and not validate_api_key(provider, api_key):
-            st.error("Invalid API key format")
-        
-        # Parameters
-        st.subheader("Parameters")
-        temperature = st.slider("Temperature", 0.0, 2.0, 0.7, 0.1)
-        max_tokens = st.slider("Max Tokens", 100, 4000, 1000, 100)
-        
-        # Memory settings
-        st.subheader("Memory")
-        use_memory = st.checkbox("Use conversation memory", value=True)
-        recall_count = st.slider("Memory recall count", 1, 10, 4, 1)
-        
-        # Token usage display
-        st.subheader("📊 Token Usage")
-        st.metric("Session Tokens", st.session_state.total_tokens_used)
-        st.metric("Estimated Cost", f"${st.session_state.total_cost:.4f}")
+        _show_config_sidebar()
+    
+    _show_chat_pane()
+
+@st.fragment
+def _show_config_sidebar():
+    """Sidebar for configuration; the chat pane reads the values from session state"""
+    llm_bridge = _get_bridge()
+    
+    st.header("⚙️ Configuration")
+    
+    # Provider selection
+    provider = st.selectbox(
+        "AI Provider",
+        ["OpenAI", "Anthropic", "Gemini"],
+        key="provider"
+    )
+    
+    # Model selection
+    available_models = llm_bridge.get_available_models(provider)
+    st.selectbox(
+        "Model",
+        available_models,
+        index=0 if available_models else 0,
+        key="model"
+    )
+    
+    # API Key input
+    api_key = st.text_input(
+        "API Key",
+        type="password",
+        placeholder=f"Enter your {provider} API key",
+        key="api_key"
+    )
+    
+    # Validate API key (once per change; reused by the chat pane's submit checks)
+    st.session_state.api_key_valid = bool(api_key) and validate_api_key(provider, api_key)
+    if api_key and not st.session_state.api_key_valid:
+        st.error("Invalid API key format")
+    
+    # Parameters
+    st.subheader("Parameters")
+    st.slider("Temperature", 0.0, 2.0, 0.7, 0.1, key="temperature")
+    st.slider("Max Tokens", 100, 4000, 1000, 100, key="max_tokens")
+    
+    # Memory settings
+    st.subheader("Memory")
+    st.checkbox("Use conversation memory", value=True, key="use_memory")
+    st.slider("Memory recall count", 1, 10, 4, 1, key="recall_count")
+
+@st.fragment
+def _show_chat_pane():
+    """Conversation, chat input, usage metrics and export controls"""
+    # Sending a message reruns only this fragment, so app.main()'s session timeout check
+    # would be skipped; hand expired sessions back to a full rerun, which logs them out
+    if session_expired(st.session_state.get("login_time")):
+        st.rerun(scope="app")
+    
+    # Initialize components (built once per process, not on every rerun)
+    llm_bridge = _get_bridge()
+    memory_manager = _get_memory()
+    token_counter = get_token_counter()
+    
+    # Configuration from the sidebar
+    provider = st.session_state.provider
+    model = st.session_state.model
+    api_key = st.session_state.api_key
+    api_key_valid = st.session_state.api_key_valid
+    temperature = st.session_state.temperature
+    max_tokens = st.session_state.max_tokens
+    use_memory = st.session_state.use_memory
+    recall_count = st.session_state.recall_count
     
     # Main chat interface
     col1, col2 = st.columns([3, 1])
     
-    with col2:
-        # Export buttons
-        if st.session_state.history:
-            # JSON export
-            json_data = format_chat_history_for_export(st.session_state.history, "json")
-            st.download_button(
-                "📥 Download JSON",
-                json_data,
-                f"chat_{st.session_state.conversation_id[:8]}.json",
-                "application/json"
-            )
-            
-            # Markdown export
-            md_data = format_chat_history_for_export(st.session_state.history, "md")
-            st.download_button(
-                "📄 Download MD",
-                md_data,
-                f"chat_{st.session_state.conversation_id[:8]}.md",
-                "text/markdown"
-            )
-            
-            # Clear conversation
-            if st.button("🗑️ Clear Chat", type="secondary"):
-                st.session_state.history = []
-                st.session_state.conversation_id = generate_conversation_id()
-                st.rerun()
-    
     with col1:
         # Display chat history
         for message in st.session_state.history:
-            role = message["role"]
-            content = message["content"]
-            timestamp = message.get("timestamp", "")
-            
-            if role == "user":
-                st.markdown(f"""
-                <div class="chat-message user-message">
-                    <strong>You</strong> <small>{timestamp}</small><br>
-                    {content}
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div class="chat-message assistant-message">
-                    <strong>Assistant</strong> <small>{timestamp}</small><br>
-                    {content}
-                </div>
-                """, unsafe_allow_html=True)
+            with st.chat_message(message["role"]):
+                timestamp = message.get("timestamp", "")
+                if timestamp:
+                    st.caption(timestamp)
+                st.markdown(message["content"])
         
         # Chat input
         user_input = st.chat_input("Type your message here...")
         
-        if user_input and api_key and validate_api_key(provider, api_key):
+        if user_input and api_key_valid:
             # Add user message to history
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             user_message = {
@@ -138,7 +161,12 @@ def show_chat_page():
                 "content": user_input,
                 "timestamp": timestamp
             }
-            st.session_state.history.append(user_message)
+            _append_history(user_message)
+            
+            # Show the new message right away; the history above was drawn before it was sent
+            with st.chat_message("user"):
+                st.caption(timestamp)
+                st.markdown(user_input)
             
             # Prepare messages for API
             messages = []
@@ -164,11 +192,12 @@ def show_chat_page():
             
             messages.append({"role": "system", "content": system_msg})
             
-            # Add recent conversation history (last 10 messages)
-            recent_history = st.session_state.history[-10:]
-            for msg in recent_history:
-                if msg["role"] in ["user", "assistant"]:
-                    messages.append({"role": msg["role"], "content": msg["content"]})
+            # Add recent conversation history (last 10 messages, without timestamps)
+            messages.extend(
+                {"role": msg["role"], "content": msg["content"]}
+                for msg in islice(st.session_state.history, max(0, len(st.session_state.history) - 10), None)
+                if msg["role"] in ("user", "assistant")
+            )
             
             # Count input tokens
             input_tokens = token_counter.count_messages_tokens(provider, model, messages)
@@ -183,88 +212,144 @@ def show_chat_page():
             
             try:
                 with st.spinner("Generating response..."):
-                    # Call LLM
-                    response = llm_bridge.chat(
+                    # Call LLM (standalone prompts may be answered from the semantic cache)
+                    response = llm_bridge.chat_cached(
                         provider=provider,
                         model=model,
                         api_key=api_key,
                         messages=messages,
+                        memory_manager=memory_manager,
+                        user_id=st.session_state.user_id,
                         temperature=temperature,
                         max_tokens=max_tokens,
-                        stream=False
+                        stream=True
                     )
-                    
-                    # Extract response content
-                    assistant_content = llm_bridge.extract_content(provider, response)
-                    
-                    # Count output tokens
-                    output_tokens = token_counter.count_tokens(provider, model, assistant_content)
-                    
-                    # Calculate cost
+                
+                # Render the reply as it streams in (cache hits arrive complete)
+                with st.chat_message("assistant"):
+                    if getattr(response, "from_cache", False):
+                        assistant_content = llm_bridge.extract_content(provider, response)
+                        st.markdown(assistant_content)
+                    else:
+                        assistant_content = st.write_stream(llm_bridge.stream_text(provider, response))
+                
+                # Count output tokens
+                output_tokens = token_counter.count_tokens(provider, model, assistant_content)
+                
+                # Calculate cost (cached responses didn't call the provider)
+                if getattr(response, "from_cache", False):
+                    estimated_cost = 0.0
+                else:
                     estimated_cost = token_counter.estimate_cost(provider, model, input_tokens, output_tokens)
-                    
-                    # Update session totals
-                    st.session_state.total_tokens_used += input_tokens + output_tokens
-                    st.session_state.total_cost += estimated_cost
-                    
-                    # Add assistant response to history
-                    assistant_message = {
-                        "role": "assistant",
-                        "content": assistant_content,
-                        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                    st.session_state.history.append(assistant_message)
-                    
-                    # Store in memory
-                    if use_memory:
-                        memory_manager.add_message(
-                            st.session_state.user_id,
-                            "user",
-                            user_input,
-                            st.session_state.conversation_id
-                        )
-                        memory_manager.add_message(
-                            st.session_state.user_id,
-                            "assistant",
-                            assistant_content,
-                            st.session_state.conversation_id
-                        )
-                    
-                    # Log analytics
-                    log_analytics(
+                
+                # Update session totals
+                st.session_state.total_tokens_used += input_tokens + output_tokens
+                st.session_state.total_cost += estimated_cost
+                
+                # Add assistant response to history
+                assistant_message = {
+                    "role": "assistant",
+                    "content": assistant_content,
+                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                }
+                _append_history(assistant_message)
+                
+                # Store in memory in the background while analytics are logged
+                memory_write = None
+                if use_memory:
+                    memory_write = memory_manager.add_messages_async(
                         st.session_state.user_id,
-                        provider,
-                        model,
-                        input_tokens,
-                        output_tokens,
-                        estimated_cost,
+                        [
+                            {"role": "user", "content": user_input},
+                            {"role": "assistant", "content": assistant_content}
+                        ],
                         st.session_state.conversation_id
                     )
+                
+                # Log analytics
+                log_analytics(
+                    st.session_state.user_id,
+                    provider,
+                    model,
+                    input_tokens,
+                    output_tokens,
+                    estimated_cost,
+                    st.session_state.conversation_id
+                )
+                
+                # Check for auto-summary (after the new messages are stored)
+                if use_memory:
+                    stored = memory_write.result()
                     
-                    # Check for auto-summary
-                    if use_memory:
-                        message_count = memory_manager.count_messages(
+                    # The stored-message count is queried once per conversation, then kept
+                    # up to date from our own writes instead of a count query every turn
+                    if st.session_state.get("memory_count_conversation_id") != st.session_state.conversation_id:
+                        st.session_state.memory_message_count = memory_manager.count_messages(
                             st.session_state.user_id,
                             st.session_state.conversation_id
                         )
-                        
-                        if message_count >= 20:
-                            with st.spinner("Creating summary..."):
-                                memory_manager.summarize_and_prune(
-                                    st.session_state.user_id,
-                                    st.session_state.conversation_id,
-                                    llm_bridge,
-                                    provider,
-                                    model,
-                                    api_key
-                                )
-                    
-                    st.rerun()
+                        st.session_state.memory_count_conversation_id = st.session_state.conversation_id
+                    elif stored:
+                        st.session_state.memory_message_count += 2
                     
+                    # Summarizing is another LLM round trip, so it runs in the background;
+                    # the summary is only read back on later turns
+                    if st.session_state.memory_message_count >= 20:
+                        memory_manager.summarize_and_prune_async(
+                            st.session_state.user_id,
+                            st.session_state.conversation_id,
+                            llm_bridge,
+                            provider,
+                            model,
+                            api_key
+                        )
+                        # Pruning will remove rows; re-count on the next turn
+                        st.session_state.memory_count_conversation_id = None
+                
             except Exception as e:
                 st.error(f"Error generating response: {str(e)}")
         
         elif user_input and not api_key:
             st.error("Please enter your API key in the sidebar")
-        elif user_input and not validate_api_key(provider, api_key):
+        elif user_input and not api_key_valid:
             st.error("Please enter a valid API key")
+    
+    # Rendered after the conversation so they include the turn just processed. They live in
+    # this fragment rather than the sidebar because a fragment only redraws its own elements,
+    # and st.sidebar can't be used from inside the chat pane's fragment body.
+    with col2:
+        # Token usage display
+        st.subheader("📊 Token Usage")
+        st.metric("Session Tokens", st.session_state.total_tokens_used)
+        st.metric("Estimated Cost", f"${st.session_state.total_cost:.4f}")
+        
+        # Export buttons
+        if st.session_state.history:
+            # JSON export
+            json_data = _export_history(
+                st.session_state.history_digest, "json", st.session_state.history
+            )
+            st.download_button(
+                "📥 Download JSON",
+                json_data,
+                f"chat_{st.session_state.conversation_id[:8]}.json",
+                "application/json"
+            )
+            
+            # Markdown export
+            md_data = _export_history(
+                st.session_state.history_digest, "md", st.session_state.history
+            )
+            st.download_button(
+                "📄 Download MD",
+                md_data,
+                f"chat_{st.session_state.conversation_id[:8]}.md",
+                "text/markdown"
+            )
+            
+            # Clear conversation
+            if st.button("🗑️ Clear Chat", type="secondary"):
+                st.session_state.history = _new_history()
+                st.session_state.history_digest = ""
+                st.session_state.conversation_id = generate_conversation_id()
+                st.rerun()
@@ -6,6 +6,7 @@ CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 CREATE EXTENSION IF NOT EXISTS vector;
 
 -- Drop existing tables if they exist (to start fresh)
+DROP TABLE IF EXISTS response_cache CASCADE;
 DROP TABLE IF EXISTS summaries CASCADE;
 DROP TABLE IF EXISTS analytics CASCADE;
 DROP TABLE IF EXISTS memory_vectors CASCADE;
@@ -28,9 +29,10 @@ CREATE TABLE memory_vectors (
     user_id UUID REFERENCES users(id) ON DELETE CASCADE,
     role VARCHAR(20) NOT NULL CHECK (role IN ('user', 'assistant', 'system')),
     content TEXT NOT NULL,
-    embedding vector(384), -- Adjust dimension based on your embedding model
+    embedding vector(384), -- Adjust dimension based on your embedding model (or EMBEDDING_DIM if set)
     conversation_id VARCHAR(255),
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    -- clock_timestamp() keeps rows of a multi-row insert in insertion order
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT clock_timestamp()
 );
 
 -- Analytics table for tracking usage
@@ -58,20 +60,45 @@ CREATE TABLE summaries (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- Semantic response cache: responses to standalone prompts, matched by embedding similarity
+CREATE TABLE response_cache (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    user_id UUID REFERENCES users(id) ON DELETE CASCADE,
+    provider VARCHAR(20) NOT NULL,
+    model VARCHAR(100) NOT NULL,
+    prompt TEXT NOT NULL,
+    response TEXT NOT NULL,
+    embedding vector(384), -- Keep in sync with memory_vectors.embedding
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
 -- Create indexes for better performance
 CREATE INDEX idx_memory_vectors_user_id ON memory_vectors(user_id);
 CREATE INDEX idx_memory_vectors_conversation_id ON memory_vectors(conversation_id);
 CREATE INDEX idx_memory_vectors_created_at ON memory_vectors(created_at);
+-- Serves get_conversation_messages (filter + ORDER BY created_at), the created_at range
+-- delete in summarize_and_prune, and distinct_conversations (via its leading columns)
+CREATE INDEX idx_memory_vectors_user_conversation_created ON memory_vectors(user_id, conversation_id, created_at);
+-- HNSW index for similarity search; vector_ip_ops matches the <#> (inner product) operator
+-- used by match_memory_vectors (embeddings are normalized, so this is cosine similarity)
+CREATE INDEX idx_memory_vectors_embedding ON memory_vectors
+    USING hnsw (embedding vector_ip_ops) WITH (m = 16, ef_construction = 64);
 CREATE INDEX idx_analytics_user_id ON analytics(user_id);
 CREATE INDEX idx_analytics_created_at ON analytics(created_at);
 CREATE INDEX idx_analytics_provider ON analytics(provider);
 CREATE INDEX idx_analytics_model ON analytics(model);
+CREATE INDEX idx_analytics_user_id_created_at ON analytics(user_id, created_at);
 CREATE INDEX idx_summaries_user_id ON summaries(user_id);
 CREATE INDEX idx_summaries_conversation_id ON summaries(conversation_id);
+CREATE INDEX idx_response_cache_lookup ON response_cache(user_id, provider, model);
+CREATE INDEX idx_response_cache_embedding ON response_cache
+    USING hnsw (embedding vector_ip_ops) WITH (m = 16, ef_construction = 64);
+-- Covering index so the admin check is an index-only lookup
+CREATE INDEX idx_users_id_is_admin ON users(id) INCLUDE (is_admin);
 
 -- Create a function for vector similarity search (UUID version)
 CREATE OR REPLACE FUNCTION match_memory_vectors(
-    query_embedding vector(384),
+    query_embedding vector(384), -- Keep in sync with memory_vectors.embedding
     match_threshold float DEFAULT 0.7,
     match_count int DEFAULT 4,
     p_user_id uuid DEFAULT NULL,
@@ -89,30 +116,228 @@ RETURNS TABLE (
 LANGUAGE plpgsql
 AS $$
 BEGIN
+    -- Widen the HNSW candidate list for larger k (transaction-local setting)
+    PERFORM set_config('hnsw.ef_search', GREATEST(match_count * 10, 40)::text, true);
+    -- The user/conversation/threshold filters are applied to HNSW candidates after the
+    -- index walk, so keep scanning until match_count rows pass them (pgvector 0.8.0+)
+    PERFORM set_config('hnsw.iterative_scan', 'relaxed_order', true);
+    
     RETURN QUERY
+    -- relaxed_order can return rows slightly out of order; re-sort the materialized matches
+    WITH matches AS MATERIALIZED (
+        SELECT
+            memory_vectors.id,
+            memory_vectors.user_id,
+            memory_vectors.role,
+            memory_vectors.content,
+            memory_vectors.conversation_id,
+            memory_vectors.embedding <#> query_embedding AS distance,
+            memory_vectors.created_at
+        FROM memory_vectors
+        WHERE 
+            (p_user_id IS NULL OR memory_vectors.user_id = p_user_id)
+            AND (p_conversation_id IS NULL OR memory_vectors.conversation_id = p_conversation_id)
+            AND (memory_vectors.embedding <#> query_embedding) * -1 > match_threshold
+        ORDER BY memory_vectors.embedding <#> query_embedding
+        LIMIT match_count
+    )
     SELECT
-        memory_vectors.id,
-        memory_vectors.user_id,
-        memory_vectors.role,
-        memory_vectors.content,
-        memory_vectors.conversation_id,
-        (memory_vectors.embedding <#> query_embedding) * -1 AS similarity,
-        memory_vectors.created_at
-    FROM memory_vectors
-    WHERE 
-        (p_user_id IS NULL OR memory_vectors.user_id = p_user_id)
-        AND (p_conversation_id IS NULL OR memory_vectors.conversation_id = p_conversation_id)
-        AND (memory_vectors.embedding <#> query_embedding) * -1 > match_threshold
-    ORDER BY memory_vectors.embedding <#> query_embedding
-    LIMIT match_count;
+        matches.id,
+        matches.user_id,
+        matches.role,
+        matches.content,
+        matches.conversation_id,
+        matches.distance * -1 AS similarity,
+        matches.created_at
+    FROM matches
+    ORDER BY matches.distance;
 END;
 $$;
 
+-- Find the closest cached response for a user's prompt on the same provider/model
+CREATE OR REPLACE FUNCTION match_response_cache(
+    query_embedding vector(384), -- Keep in sync with response_cache.embedding
+    match_threshold float DEFAULT 0.92,
+    match_count int DEFAULT 1,
+    p_user_id uuid DEFAULT NULL,
+    p_provider varchar DEFAULT NULL,
+    p_model varchar DEFAULT NULL
+)
+RETURNS TABLE (
+    response text,
+    similarity float
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- Keep scanning the HNSW index until a row passes the per-user filters (pgvector 0.8.0+)
+    PERFORM set_config('hnsw.iterative_scan', 'relaxed_order', true);
+    
+    RETURN QUERY
+    WITH matches AS MATERIALIZED (
+        SELECT
+            response_cache.response,
+            response_cache.embedding <#> query_embedding AS distance
+        FROM response_cache
+        WHERE
+            response_cache.user_id = p_user_id
+            AND response_cache.provider = p_provider
+            AND response_cache.model = p_model
+            AND (response_cache.embedding <#> query_embedding) * -1 > match_threshold
+        ORDER BY response_cache.embedding <#> query_embedding
+        LIMIT match_count
+    )
+    SELECT matches.response, matches.distance * -1 AS similarity
+    FROM matches
+    ORDER BY matches.distance;
+END;
+$$;
+
+-- Distinct conversation IDs for a user (served from idx_memory_vectors_user_conversation_created)
+CREATE OR REPLACE FUNCTION distinct_conversations(p_user_id uuid)
+RETURNS TABLE (conversation_id varchar)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT DISTINCT memory_vectors.conversation_id
+    FROM memory_vectors
+    WHERE memory_vectors.user_id = p_user_id
+      AND memory_vectors.conversation_id IS NOT NULL;
+$$;
+
+-- Per-user usage totals and favorites over the last N days, aggregated in the database
+CREATE OR REPLACE FUNCTION user_stats(p_user_id uuid, p_days int DEFAULT 30)
+RETURNS TABLE (
+    total_requests bigint,
+    total_tokens bigint,
+    total_cost numeric,
+    favorite_provider varchar,
+    favorite_model varchar
+)
+LANGUAGE sql
+STABLE
+AS $$
+    WITH recent AS (
+        SELECT analytics.provider, analytics.model, analytics.total_tokens, analytics.estimated_cost
+        FROM analytics
+        WHERE analytics.user_id = p_user_id
+          AND analytics.created_at >= NOW() - make_interval(days => p_days)
+    )
+    SELECT
+        COUNT(*),
+        COALESCE(SUM(recent.total_tokens), 0),
+        COALESCE(SUM(recent.estimated_cost), 0),
+        (SELECT recent.provider FROM recent GROUP BY recent.provider ORDER BY COUNT(*) DESC LIMIT 1),
+        (SELECT recent.model FROM recent GROUP BY recent.model ORDER BY COUNT(*) DESC LIMIT 1)
+    FROM recent;
+$$;
+
+-- Admin dashboard data for analytics rows created in [p_start, p_end], returned as one JSON
+-- document. The window is scanned once into a CTE and every panel aggregates from it.
+CREATE OR REPLACE FUNCTION admin_dashboard(
+    p_start timestamptz,
+    p_end timestamptz,
+    p_model_limit int DEFAULT 10,
+    p_user_limit int DEFAULT 20,
+    p_recent_limit int DEFAULT 50
+)
+RETURNS json
+LANGUAGE sql
+STABLE
+AS $$
+    WITH windowed AS MATERIALIZED (
+        SELECT
+            analytics.user_id,
+            analytics.provider,
+            analytics.model,
+            analytics.total_tokens,
+            analytics.estimated_cost,
+            analytics.created_at
+        FROM analytics
+        WHERE analytics.created_at BETWEEN p_start AND p_end
+    )
+    SELECT json_build_object(
+        'overview', (
+            SELECT json_build_object(
+                'total_requests', COUNT(*),
+                'total_tokens', COALESCE(SUM(total_tokens), 0),
+                'total_cost', COALESCE(SUM(estimated_cost), 0),
+                'unique_users', COUNT(DISTINCT user_id)
+            )
+            FROM windowed
+        ),
+        'daily', COALESCE((
+            SELECT json_agg(d ORDER BY d.date)
+            FROM (
+                SELECT created_at::date AS date, COUNT(*) AS requests,
+                       SUM(total_tokens) AS total_tokens, SUM(estimated_cost) AS estimated_cost
+                FROM windowed
+                GROUP BY 1
+            ) d
+        ), '[]'::json),
+        'providers', COALESCE((
+            SELECT json_agg(p)
+            FROM (
+                SELECT provider, COUNT(*) AS requests, SUM(total_tokens) AS total_tokens
+                FROM windowed
+                GROUP BY 1
+            ) p
+        ), '[]'::json),
+        'models', COALESCE((
+            SELECT json_agg(m ORDER BY m.requests DESC)
+            FROM (
+                SELECT model, COUNT(*) AS requests, SUM(total_tokens) AS total_tokens
+                FROM windowed
+                GROUP BY 1
+                ORDER BY 2 DESC
+                LIMIT p_model_limit
+            ) m
+        ), '[]'::json),
+        'top_users', COALESCE((
+            SELECT json_agg(u ORDER BY u.requests DESC)
+            FROM (
+                SELECT user_id, COUNT(*) AS requests,
+                       SUM(total_tokens) AS total_tokens, SUM(estimated_cost) AS estimated_cost
+                FROM windowed
+                GROUP BY 1
+                ORDER BY 2 DESC
+                LIMIT p_user_limit
+            ) u
+        ), '[]'::json),
+        'recent', COALESCE((
+            SELECT json_agg(json_build_object(
+                'user_id', r.user_id,
+                'provider', r.provider,
+                'model', r.model,
+                'total_tokens', r.total_tokens,
+                'estimated_cost', r.estimated_cost,
+                'created_at', to_char(r.created_at, 'YYYY-MM-DD HH24:MI:SS')
+            ) ORDER BY r.created_at DESC)
+            FROM (
+                SELECT *
+                FROM windowed
+                ORDER BY windowed.created_at DESC
+                LIMIT p_recent_limit
+            ) r
+        ), '[]'::json)
+    );
+$$;
+
+-- Admin check returning a single boolean (smaller payload than a row select)
+CREATE OR REPLACE FUNCTION is_admin(uid uuid)
+RETURNS boolean
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT COALESCE((SELECT users.is_admin FROM users WHERE users.id = uid), false);
+$$;
+
 -- Enable RLS (Row Level Security)
 ALTER TABLE users ENABLE ROW LEVEL SECURITY;
 ALTER TABLE memory_vectors ENABLE ROW LEVEL SECURITY;
 ALTER TABLE analytics ENABLE ROW LEVEL SECURITY;
 ALTER TABLE summaries ENABLE ROW LEVEL SECURITY;
+ALTER TABLE response_cache ENABLE ROW LEVEL SECURITY;
 
 -- Create policies for users table
 CREATE POLICY "Enable read access for users to their own data" ON users
@@ -148,6 +373,13 @@ CREATE POLICY "Enable read access for users to their own summaries" ON summaries
 CREATE POLICY "Enable insert for users on their own summaries" ON summaries
     FOR INSERT WITH CHECK (true); -- We'll handle user validation in the application
 
+-- Create policies for response_cache table
+CREATE POLICY "Enable read access for users to their own cached responses" ON response_cache
+    FOR SELECT USING (true); -- We'll handle user filtering in the application
+
+CREATE POLICY "Enable insert for users on their own cached responses" ON response_cache
+    FOR INSERT WITH CHECK (true); -- We'll handle user validation in the application
+
 -- Create trigger to update updated_at timestamp
 CREATE OR REPLACE FUNCTION update_updated_at_column()
 RETURNS TRIGGER AS $$
@@ -174,7 +406,7 @@ VALUES (
 DO $$
 BEGIN
     RAISE NOTICE 'Database schema setup completed successfully!';
-    RAISE NOTICE 'Tables created: users, memory_vectors, analytics, summaries';
+    RAISE NOTICE 'Tables created: users, memory_vectors, analytics, summaries, response_cache';
     RAISE NOTICE 'Default admin user: username=admin, password=admin123';
     RAISE NOTICE 'Please change the admin password after first login!';
 END